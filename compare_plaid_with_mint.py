@@ -35,18 +35,22 @@
 
     To facilitate manual analysis, the files are sorted in order of Account Name, and
     then descending date.  Note that different account names can stymie the analysis,
-    see the documentation for the filter_matches_by_account function in the
+    see the documentation for the get_account_synonyms function in the
     find_duplicates.py module for details on how to resolve this
 """
 
-from datetime import datetime
+import functools
+import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import sys
 
 # Local modules
 from lib import find_duplicates as fd
 from lib import transactions as trans
+from lib.local_transaction_utils import write_csv
 from config import lunchmoney_config as lmc
 
 # Check that API Token is set
@@ -55,8 +59,27 @@ if lmc.LUNCHMONEY_API_TOKEN == "":
     print("Obtain a token from a https://my.lunchmoney.app/developers")
     sys.exit()
 
-START_DATE = datetime.strptime(lmc.START_DATE_STR, "%m/%d/%Y")
-END_DATE = datetime.strptime(lmc.END_DATE_STR, "%m/%d/%Y")
+START_DATE = pd.to_datetime(lmc.START_DATE_STR, format="%m/%d/%Y")
+END_DATE = pd.to_datetime(lmc.END_DATE_STR, format="%m/%d/%Y")
+
+# Low cardinality string columns that are stored as categoricals
+PLAID_CATEGORY_COLUMNS = [
+    "category_name",
+    "plaid_account_id",
+    "account_display_name",
+    "source",
+]
+MINT_CATEGORY_COLUMNS = ["Account Name", "Category", "Transaction Type"]
+
+# Input and output files
+MINT_CSV_PATH = os.path.join(lmc.INPUT_FILES, lmc.MINT_CSV_FILE)
+ACCOUNT_NAME_MAP_PATH = os.path.join(lmc.CONFIG_FILES, lmc.ACCOUNT_NAME_MAP_FILE)
+PLAID_OUTPUT_PATH = os.path.join(lmc.OUTPUT_FILES, "plaid_analyzed_transactions.csv")
+MINT_OUTPUT_PATH = os.path.join(lmc.OUTPUT_FILES, "mint_analyzed_transactions.csv")
+IGNORED_OUTPUT_PATH = os.path.join(lmc.OUTPUT_FILES, "ignored_transactions.csv")
+# Older configs won't have this setting, default to not writing the file
+WRITE_IGNORED = getattr(lmc, "WRITE_IGNORED", False)
+IGNORED_COLUMNS = ["id", "date", "payee", "amount", "source"]
 
 
 def main():
@@ -73,26 +96,22 @@ def main():
             "related_id" - id of the lunchmoney transaction in the plaid CSV output
     """
     plaid_df = prepare_plaid_dataset(START_DATE, END_DATE)
-    mint_df = prepare_mint_dataset(os.path.join(lmc.INPUT_FILES, lmc.MINT_CSV_FILE))
+    mint_df = prepare_mint_dataset(MINT_CSV_PATH)
 
     # Read in the mapping of LM/Mint Account Name synonyms
-    act_name_map_file = os.path.join(lmc.CONFIG_FILES, lmc.ACCOUNT_NAME_MAP_FILE)
-    if os.path.isfile(act_name_map_file):
-        acct_name_df = pd.read_csv(act_name_map_file)
-    else:
-        acct_name_df = None
+    acct_name_df = read_account_name_map(ACCOUNT_NAME_MAP_PATH)
 
     # Try to correlate each of the Plaid transactions with the ones from Mint
     print(f"Correlating {len(plaid_df)} transactions with mint data")
-    (plaid_df, mint_df) = fd.find_duplicates(
+    (plaid_df, mint_df, match_pairs) = fd.find_duplicates(
         plaid_df,
         mint_df,
-        update_fn=report_findings,
         acct_name_df=acct_name_df,
         lookback_days=lmc.LOOKBACK_DAYS,
         lookahead_days=lmc.LOOKAHEAD_DAYS,
         old_type="mint",
     )
+    report_findings(plaid_df, mint_df, match_pairs)
     duplicate_count = (plaid_df["action"] == "Duplicate").sum()
     investigate_count = (plaid_df["action"] == "Investigate").sum()
     print(
@@ -105,34 +124,92 @@ def main():
         "Look for plaid_analyzed_transactions.csv and mint_analyzed_transactions.csv "
         f"in the {lmc.OUTPUT_FILES} directory to begin the analysis"
     )
-    plaid_df.to_csv(
-        os.path.join(lmc.OUTPUT_FILES, "plaid_analyzed_transactions.csv"), index=False
-    )
-    mint_df["Date"] = mint_df["Date"].dt.strftime(lmc.MINT_DATE_FORMAT)
-    mint_df.to_csv(
-        os.path.join(lmc.OUTPUT_FILES, "mint_analyzed_transactions.csv"), index=True
-    )
+    write_csv(plaid_df, PLAID_OUTPUT_PATH)
+    mint_df["Date"] = format_dates(mint_df["Date"], lmc.MINT_DATE_FORMAT)
+    write_csv(mint_df, MINT_OUTPUT_PATH, index=True)
 
 
-def report_findings(lm_df, lm_index, mint_df, mint_index):
-    """This function is called by the find_duplicates function after it
-    has identified a plaid transaction has a counterpart in the mint data.
+@functools.lru_cache(maxsize=None)
+def read_account_name_map(account_name_map_file):
+    """Returns a dataframe of LM/Mint account name synonyms, or None if there is
+    no account name map file.
+
+    The map is only read once, so running main again (for example from a
+    notebook) doesn't re-read it.  The dataframe is shared, so don't modify it
+    """
+    if os.path.isfile(account_name_map_file):
+        return pd.read_csv(account_name_map_file)
+    return None
 
-    We update the lunchmoney transaction row with the "action" of "Duplicate" and
+
+def report_findings(lm_df, mint_df, match_pairs):
+    """This function is called with the positions of each plaid transaction
+    that the find_duplicates function found a counterpart for in the mint data.
+
+    We update the lunchmoney transaction rows with the "action" of "Duplicate" and
     set the "related_id" cell to the index of the matching row in the mint data
     (since Mint transactions do not have a unique transaction ID)
 
-    We update the matching mint transaction row with an "action" of "Match and
+    We update the matching mint transaction rows with an "action" of "Match and
     set the "related_id" cell the transaction id of matching lunchmoney transaction
+
+    All the matches are written with one assignment per column rather than row by
+    row
+    """
+    lm_pos, mint_pos = match_pairs.T
+    lm_df.iloc[lm_pos, lm_df.columns.get_loc("action")] = "Duplicate"
+    lm_df.iloc[lm_pos, lm_df.columns.get_loc("related_id")] = mint_df.index[mint_pos]
+    mint_df.iloc[mint_pos, mint_df.columns.get_loc("action")] = "Match"
+    mint_df.iloc[mint_pos, mint_df.columns.get_loc("related_id")] = lm_df["id"].iloc[
+        lm_pos
+    ].to_numpy()
+
+
+def format_dates(dates, date_format):
+    """Returns the Series of dates as strings in date_format.
+
+    dt.strftime formats each date in python, so the default ISO format
+    is formatted by numpy in a single vectorized call instead
     """
-    lm_df.loc[lm_index, ["action", "related_id"]] = [
-        "Duplicate",
-        mint_index,
-    ]
-    mint_df.loc[mint_index, ["action", "related_id"]] = [
-        "Match",
-        lm_df.loc[lm_index, "id"],
-    ]
+    if date_format != "%Y-%m-%d":
+        return dates.dt.strftime(date_format)
+    days = dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    formatted = np.datetime_as_string(days, unit="D").astype(object)
+    formatted[np.isnat(days)] = None
+    return pd.Series(formatted, index=dates.index)
+
+
+def downcast_columns(df, category_columns, amount_column):
+    """Converts the repetitive string columns in df to categoricals and the amount
+    column to float32, which roughly halves the memory that every later filter
+    and sort has to scan.  The columns are replaced in place and df is returned.
+
+    The amounts are only downcast if every amount still rounds to the same number
+    of cents, so very large amounts never lose precision
+    """
+    for column in category_columns:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    if amount_column in df.columns and pd.api.types.is_float_dtype(df[amount_column]):
+        amounts = df[amount_column].to_numpy(dtype=np.float64)
+        downcast = amounts.astype(np.float32)
+        cents = np.round(amounts * 100)
+        if np.array_equal(
+            np.round(downcast.astype(np.float64) * 100), cents, equal_nan=True
+        ):
+            df[amount_column] = downcast
+    return df
+
+
+def split_by_source(df, source):
+    """Returns a pair of dataframes with the transactions in df that have the
+    specified source, and all the others (including any without a source).
+
+    The source column is compared once and the mask reused for both halves,
+    which is a single integer compare when the column is a categorical
+    """
+    is_source = (df["source"] == source).to_numpy(dtype=bool)
+    return df[is_source], df[~is_source]
 
 
 def sort_by_account_date(df, acct_name, date):
@@ -150,14 +227,17 @@ def prepare_plaid_dataset(start_date, end_date):
     Returns: dataframe of lunchmoney transactions that were pulled via the plaid
              integration, sorted by account and descending date of transactions
 
-    A side effect of this function is to write a csv file 'ignored_transactions.csv'
-    which contains any transactions with a "source" value other than "plaid"
+    If WRITE_IGNORED is set in the config, a side effect of this function is to
+    write a csv file 'ignored_transactions.csv' which contains the key fields of
+    any transactions with a "source" value other than "plaid"
     """
     df = trans.read_or_fetch_lm_transactions(start_date, end_date)
-    if "action" not in df.columns and "related_id" not in df.columns:
+    unprocessed = "action" not in df.columns and "related_id" not in df.columns
+    if unprocessed:
         # This a previously unprocessed data pull from LunchMoney,
         # Thin out the columns, add our analysis columns, and sort
-        df = df[
+        df = df.loc[
+            :,
             [
                 "id",
                 "date",
@@ -168,50 +248,66 @@ def prepare_plaid_dataset(start_date, end_date):
                 "account_display_name",
                 "source",
             ]
-        ].copy()
-        df["action"] = None
-        df["related_id"] = None
-        plaid_df = df[df.source == "plaid"]
+        ]
+        df["action"] = pd.Series(pd.NA, index=df.index, dtype="string")
+        df["related_id"] = pd.Series(pd.NA, index=df.index, dtype="Int64")
+    df = downcast_columns(df, PLAID_CATEGORY_COLUMNS, "amount")
+
+    plaid_df, other_df = split_by_source(df, "plaid")
+    if unprocessed:
         plaid_df = sort_by_account_date(plaid_df, "account_display_name", "date")
     else:
         plaid_df = df
 
-    other_df = df[~df.source.isin(["plaid"])]
     if len(other_df):
-        print(
-            f"Found {len(other_df)} transactions with a source other than plaid.\n"
-            "These are ignored and in ignored_transactions.csv"
-        )
-        other_df.to_csv(os.path.join(lmc.OUTPUT_FILES, "ignored_transactions.csv"))
+        print(f"Found {len(other_df)} transactions with a source other than plaid.")
+        if WRITE_IGNORED:
+            print("These are ignored and in ignored_transactions.csv")
+            write_csv(other_df[IGNORED_COLUMNS], IGNORED_OUTPUT_PATH, index=True)
+        else:
+            print("These are ignored, set WRITE_IGNORED in the config to list them")
 
     return plaid_df
 
 
+def read_mint_csv(mint_csv_file):
+    """Reads a csv file of mint transactions into a pyarrow Table using pyarrow's
+    multithreaded csv reader.  The "Date" column is parsed using either the
+    MINT_DATE_FORMAT or the format Excel uses when the file was re-saved, and
+    empty cells are read as missing values just like pd.read_csv
+    """
+    return pacsv.read_csv(
+        mint_csv_file,
+        convert_options=pacsv.ConvertOptions(
+            column_types={"Date": pa.timestamp("ns")},
+            timestamp_parsers=[lmc.MINT_DATE_FORMAT, "%m/%d/%y"],
+            strings_can_be_null=True,
+        ),
+    )
+
+
 def prepare_mint_dataset(mint_csv_file):
     """This function reads a set of transactions exported from Mint into
     a dataframe while adding the new "analysis" and "related_id" columns
 
     Returns: dataframe of mint transactions with the new empty columns
     """
-    df = pd.read_csv(
-        mint_csv_file, parse_dates=["Date"], date_format=lmc.MINT_DATE_FORMAT
-    )
+    table = read_mint_csv(mint_csv_file)
 
-    if "action" not in df.columns and "related_id" not in df.columns:
+    if "action" not in table.column_names and "related_id" not in table.column_names:
         # This a previously unprocessed export from Mint,
-        # Add our analysis columns, sort and reindex
+        # Sort it by account and descending date while it is still an arrow
+        # table, which uses all the cores, then add our analysis columns.
+        # Since Mint transactions don't include a unique ID we'll use the index
+        df = table.sort_by(
+            [("Account Name", "ascending"), ("Date", "descending")]
+        ).to_pandas()
         df["action"] = None
         df["related_id"] = None
-        df = sort_by_account_date(df, "Account Name", "Date")
-
-        # Since Mint transactions don't include a unique ID we'll use the index
-        df.reset_index(drop=True, inplace=True)
     else:
-        # Reread the file, using the existing indexes from a previous analysis
-        df = pd.read_csv(
-            mint_csv_file, parse_dates=["Date"], index_col=0, date_format="%m/%d/%y"
-        )
-
-    return df
-
+        # Use the existing indexes from a previous analysis, in the first column
+        df = table.to_pandas()
+        df = df.set_index(df.columns[0])
+        df.index.name = None
 
+    return downcast_columns(df, MINT_CATEGORY_COLUMNS, "Amount")
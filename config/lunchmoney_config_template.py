@@ -8,6 +8,9 @@
 ###################################
 # Lunchmoney API Token available here: https://my.lunchmoney.app/developers
 LUNCHMONEY_API_TOKEN = "<YOUR_TOKEN_HERE>"
+# Maximum number of API requests per second made by the scripts that update many
+# categories or transactions at once
+LM_API_REQUESTS_PER_SECOND = 5
 
 ###################################
 # Cache File for read_or_fetch_lm_transactions in lib/transactions
@@ -16,6 +19,8 @@ LUNCHMONEY_API_TOKEN = "<YOUR_TOKEN_HERE>"
 CACHE_DIR = "/tmp"
 # Name for local cache of fetched transactions, handy for iterative development
 LM_FETCHED_TRANSACTIONS_CACHE = "lm_transactions"
+# File type for the cache, ".parquet" is much faster to read than ".csv"
+LM_FETCHED_TRANSACTIONS_CACHE_EXT = ".parquet"
 
 ###################################
 # Default location for input and output files
@@ -40,6 +45,8 @@ END_DATE_STR = "4/25/2024"
 #####################################
 # Variables used by update_local_transaction_data.py
 #####################################
+# Use a ".parquet" file name for much faster reads and writes than ".csv", an
+# existing ".csv" file with the same name is converted the next time it is updated
 PATH_TO_LOCAL_TRANSACTIONS = "lm-transaction-backup.csv"
 # Validate that local data has required fields
 DATE = "date"
@@ -85,6 +92,13 @@ PAYEE_TERMINATOR = "-"
 EMPTY_PAYEE_STRING = "???"
 
 
+###################################
+# Variables used by fix_negative_credits.py
+###################################
+# Transactions with these payees that are not income will have their amounts negated
+PAYEES = frozenset({"<PAYEE_NAME>"})
+
+
 ###################################
 # Variables used by compare_plaid_with_mint.py  and get_new_transactions.py
 ###################################
@@ -110,11 +124,20 @@ MINT_DATE_FORMAT = "%Y-%m-%d"
 # Investigate, requiring more post run manual analysis.
 LOOKBACK_DAYS = 1
 LOOKAHEAD_DAYS = 7
+# When several transactions in the window could be the duplicate, they are scored
+# by how similar their payees are, less 0.05 for each day they are apart.  If the
+# best one beats all the others by at least this much it is picked without asking.
+# Set to None to always be asked
+AUTO_MATCH_MARGIN = 0.5
 
 # An optional csv file that maps account names as they appear in LunchMoney to how
 # they appear in the exported Mint transactions
 ACCOUNT_NAME_MAP_FILE = "account_name_map.csv"
 
+# Set to True to write the transactions with a source other than plaid, which are
+# ignored by compare_plaid_with_mint.py, to ignored_transactions.csv
+WRITE_IGNORED = False
+
 ###################################
 # Variables used by prep_categories.py
 ###################################
@@ -11,9 +11,11 @@
 
 import json
 import os
-import time
-from lib.categories import update_category, create_category_group
+from functools import partial
+from lib.categories import update_category, create_category_group, init_lunchable
+from lib.rate_limiter import run_rate_limited
 from config.lunchmoney_config import (
+    LUNCHMONEY_API_TOKEN,
     INPUT_FILES,
     CATEGORY_GROUP_DEFINITIONS,
     CATEGORY_ASSIGNMENTS,
@@ -65,17 +67,21 @@ def rename_categories_with_proposed_group_name(categories):
     "Misc" is added to the existing category name
     """
     print("\nRenaming existing categories with proposed group names...")
-    num_renamed = 0
+    lunch = init_lunchable(LUNCHMONEY_API_TOKEN)
+    renames = []
     for cat in categories:
         if cat.get("action") == "rename":
-            num_renamed += 1
             name = cat["name"]
             new_name = f"{cat['name']} Misc"
             print(f"Renaming '{name}' to '{new_name}'")
-            if not update_category(cat["id"], name=new_name):
-                print("Failed")
-                exit(1)
-            time.sleep(1)  # Adding a delay to avoid hitting rate limits
+            renames.append(
+                partial(update_category, cat["id"], name=new_name, lunch=lunch)
+            )
+    # Make the API calls concurrently, staying under the API rate limit
+    if not all(run_rate_limited(renames)):
+        print("Failed")
+        exit(1)
+    num_renamed = len(renames)
     if num_renamed == 0:
         print("...Did not find any categories that needed to be renamed")
 
@@ -83,7 +89,8 @@ def rename_categories_with_proposed_group_name(categories):
 def create_proposed_category_groups(groups):
     """Creates the proposed category groups"""
     print("\nCreating proposed category groups...")
-    num_created = 0
+    lunch = init_lunchable(LUNCHMONEY_API_TOKEN)
+    creates = []
     for group in groups:
         if "type" in group and group["type"] == "to_be_created":
             name = group["name"]
@@ -92,10 +99,18 @@ def create_proposed_category_groups(groups):
             if "categories_to_add" in group:
                 sub_categories = group["categories_to_add"]
                 num_sub_cats = len(sub_categories)
-            num_created += 1
             print(f"Creating group '{name}' with {num_sub_cats} sub categories")
-            create_category_group(name, category_ids=sub_categories)
-            time.sleep(1)  # Adding a delay to avoid hitting rate limits
+            creates.append(
+                partial(
+                    create_category_group,
+                    name,
+                    category_ids=sub_categories,
+                    lunch=lunch,
+                )
+            )
+    # Make the API calls concurrently, staying under the API rate limit
+    run_rate_limited(creates)
+    num_created = len(creates)
     if num_created == 0:
         print("...did not find any proposed category groups that did not already exist")
 
@@ -17,8 +17,10 @@
 # fix_negative_credits.py
 import asyncio
 from datetime import datetime  # Manual add, did not prompt about this
-from lunchable import LunchMoney
+from functools import partial
 from lunchable.models import TransactionUpdateObject # Manual add
+from lib.lm_client import init_lunchable
+from lib.rate_limiter import run_rate_limited
 """from config.lunchmoney_config import PAYEES  # Ensure this module exists and is correctly configured"""
 from config import lunchmoney_config as lmc
 
@@ -26,10 +28,13 @@ from config import lunchmoney_config as lmc
 START_DATE = datetime.strptime(lmc.START_DATE_STR, "%m/%d/%Y")
 END_DATE = datetime.strptime(lmc.END_DATE_STR, "%m/%d/%Y")
 """"""
+# A set makes checking each transaction's payee a hash lookup
+PAYEES = frozenset(lmc.PAYEES)
 
 # Initialize LunchMoney client
 """lunch = LunchMoney()"""
-lunch = LunchMoney(lmc.LUNCHMONEY_API_TOKEN)
+# The shared client keeps the updates below under the API rate limit
+lunch = init_lunchable(lmc.LUNCHMONEY_API_TOKEN)
 
 
 async def fix_negative_credits():
@@ -41,9 +46,10 @@ async def fix_negative_credits():
     """filtered_transactions = [t for t in transactions if t.payee in PAYEES and t.amount < 0]"""
     # My fault...I gave the AI the wrong column name, and it turns out I want to change amounts greater than 0
     # meaning that credits, actually have a negative amount, and expenses have a positive amount
-    filtered_transactions = [t for t in transactions if t.payee in lmc.PAYEES and not t.is_income]
+    filtered_transactions = [t for t in transactions if t.payee in PAYEES and not t.is_income]
 
-    # Update each filtered transaction
+    # Update each filtered transaction, the updates are made concurrently below
+    updates = []
     for transaction in filtered_transactions:
         """updated_amount = abs(transaction.amount)"""
         updated_amount = 0 - transaction.to_base
@@ -53,7 +59,19 @@ async def fix_negative_credits():
             transaction={"amount": updated_amount}
         )"""
         income_update = TransactionUpdateObject(amount=updated_amount)
-        lunch.update_transaction(transaction_id=transaction.id, transaction=income_update)
-        print(f"Updated transaction {transaction.id} to have amount {updated_amount}")
+        updates.append(
+            partial(
+                lunch.update_transaction,
+                transaction_id=transaction.id,
+                transaction=income_update,
+            )
+        )
+    results = run_rate_limited(updates, return_exceptions=True)
+    for transaction, result in zip(filtered_transactions, results):
+        if isinstance(result, Exception):
+            print(f"Failed to update transaction {transaction.id}: {result}")
+        else:
+            updated_amount = 0 - transaction.to_base
+            print(f"Updated transaction {transaction.id} to have amount {updated_amount}")
 
 asyncio.run(fix_negative_credits())
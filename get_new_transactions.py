@@ -1,11 +1,15 @@
+import numpy as np
 import os
 import pandas as pd
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from lib.transactions import (
     read_or_fetch_lm_transactions,
-    lunchmoney_update_transaction,
+    lunchmoney_update_transactions,
+    queue_transaction_update,
 )
-from lib.categories import get_category_id_by_name
+from lib.categories import get_categories, get_category_id_by_name
 from lib.find_duplicates import find_duplicates
 from config.lunchmoney_config import (
     MINT_CSV_FILE,
@@ -15,6 +19,23 @@ from config.lunchmoney_config import (
     LOOKBACK_TRANSACTION_DAYS,
 )
 
+# Number of rows formatted at a time when writing the merged transactions file
+MERGED_CSV_CHUNK_ROWS = 50_000
+
+# Types of the columns in MINT_CSV_FILE, so pandas doesn't have to infer them.
+# Amount stays a float64 so that the amounts are written back out unchanged, and
+# Category is a string since process_duplicate may set it to a new category
+MINT_CSV_DTYPES = {
+    "Description": "str",
+    "Original Description": "str",
+    "Amount": "float64",
+    "Transaction Type": "category",
+    "Category": "str",
+    "Account Name": "category",
+    "Labels": "str",
+    "Notes": "str",
+}
+
 
 def main():
     """
@@ -28,32 +49,83 @@ def main():
     are already in MINT_CSV_FILE, and then add the remaining transactions
     to MINT_CSV_FILE in OUPUT_FILES
     """
+    # The categories are needed to update changed duplicates in LunchMoney, fetch
+    # them in the background while the transactions are read and fetched
+    executor = ThreadPoolExecutor(max_workers=1)
+    categories_future = executor.submit(get_categories)
+    executor.shutdown(wait=False)
+
     existing_df = get_existing_transactions(
         INPUT_FILES, MINT_CSV_FILE, MINT_DATE_FORMAT
     )
     new_transactions_df = get_new_lunchmoney_transactions(
         existing_df, LOOKBACK_TRANSACTION_DAYS
     )
+    try:
+        categories_future.result()
+    except Exception:
+        # get_category_id_by_name will fetch them again if they are needed
+        pass
 
     # Exit if there are any transactions that still need to be cleared or categorized
     exit_if_transactions_not_ready(new_transactions_df)
 
-    # Remove or update any duplicate transactions
-    to_add_df, existing_df = find_duplicates(
-        new_transactions_df.copy(),
-        existing_df,
-        process_duplicate,  # defined below
-        lookahead_days=0,
-        lookback_days=0,
-        old_type="mint",
+    # Normalize the fields that are compared for each duplicate once, up front
+    new_values = values_by_index(
+        normalize_empty_values(
+            new_transactions_df[["payee", "category_name", "notes", "tag_str"]]
+        )
+    )
+    existing_values = values_by_index(
+        normalize_empty_values(
+            existing_df[["Description", "Category", "Notes", "Labels"]]
+        )
     )
 
+    # Remove or update any duplicate transactions, the LunchMoney updates are
+    # queued in pending_updates and made together once all duplicates are checked,
+    # or the check is interrupted, and the duplicates are removed from to_add_df
+    # all at once at the end.
+    # find_duplicates only adds an action column to new_transactions_df, so it
+    # doesn't need to be copied
+    pending_updates = {}
+    duplicate_indices = []
+    try:
+        to_add_df, existing_df = find_duplicates(
+            new_transactions_df,
+            existing_df,
+            partial(  # defined below
+                process_duplicate,
+                new_values=new_values,
+                existing_values=existing_values,
+                pending_updates=pending_updates,
+                duplicate_indices=duplicate_indices,
+            ),
+            lookahead_days=0,
+            lookback_days=0,
+            old_type="mint",
+        )
+    finally:
+        # Make the updates for the answers already given even if the user stops
+        # partway through with Ctrl-C, or something goes wrong
+        lunchmoney_update_transactions(pending_updates)
+    to_add_df = to_add_df.drop(duplicate_indices)
+
     print(f"Found {len(new_transactions_df) - len(to_add_df)} duplicates")
     # Merge the new transactions with the existing ones and output the file
     merge_and_output(existing_df, to_add_df, OUTPUT_FILES, MINT_CSV_FILE)
 
 
-def process_duplicate(new_df, new_index, existing_df, existing_index):
+def process_duplicate(
+    new_df,
+    new_index,
+    existing_df,
+    existing_index,
+    new_values,
+    existing_values,
+    pending_updates,
+    duplicate_indices,
+):
     """This function is called by the find_duplicates function after it
     has identified a lunchmoney transaction with a counterpart in the mint data.
 
@@ -62,89 +134,92 @@ def process_duplicate(new_df, new_index, existing_df, existing_index):
 
     If differences are detected we check with the user which one is correct and update
     the legacy transactions either in Lunchmoney or in the mint transactions file.
+
+    new_values and existing_values map the index of each transaction to a tuple of
+    its payee, category, notes and tags, as returned by values_by_index
+
+    Updates to LunchMoney transactions are queued in pending_updates, to be made
+    by lunchmoney_update_transactions, and the index of the duplicate is added to
+    duplicate_indices rather than dropping it from new_df one row at a time
     """
 
     # Date, account, and amount match.
     # Let's check if payee, category, tags and notes do also
-    new_values = new_df.loc[new_index, ["payee", "category_name", "notes"]].tolist()
-    new_values.append(
-        f'{" ".join([tag["name"] for tag in new_df.loc[new_index, "tags"]])}'
-    )
-    existing_values = existing_df.loc[
-        existing_index, ["Description", "Category", "Notes", "Labels"]
-    ].tolist()
-
-    # Replace NaN, None, and empty lists with an empty string
-    new_values = normalize_empty_values(new_values)
-    existing_values = normalize_empty_values(existing_values)
+    new_fields = new_values[new_index]
+    existing_fields = existing_values[existing_index]
 
     # Check if the values are the same
-    if new_values == existing_values:
+    if new_fields == existing_fields:
+        new_row = new_df.loc[new_index]
         print("Ignoring Existing Transaction:")
         print(
-            f'{new_df.loc[new_index, "date"]}: '
-            f'{new_df.loc[new_index, "category_name"]}, '
-            f'{new_df.loc[new_index, "payee"]}, '
-            f'{new_df.loc[new_index, "amount"]}, '
-            f'{new_df.loc[new_index, "notes"]}, '
-            f"{new_values[-1]}"
+            f'{new_row["date"]}: '
+            f'{new_row["category_name"]}, '
+            f'{new_row["payee"]}, '
+            f'{new_row["amount"]}, '
+            f'{new_row["notes"]}, '
+            f"{new_fields[-1]}"
         )
     else:
+        new_row = new_df.loc[new_index]
+        existing_row = existing_df.loc[existing_index]
         print("Existing Transaction has been updated since last import:")
         print(
-            f'Old: {existing_df.loc[existing_index, "Date"]}: '
-            f'{existing_df.loc[existing_index, "Category"]}, '
-            f'{existing_df.loc[existing_index, "Description"]}, '
-            f'{existing_df.loc[existing_index, "Amount"]}, '
-            f'{existing_df.loc[existing_index, "Notes"]}, '
-            f'{existing_df.loc[existing_index, "Labels"]}'
+            f'Old: {existing_row["Date"]}: '
+            f'{existing_row["Category"]}, '
+            f'{existing_row["Description"]}, '
+            f'{existing_row["Amount"]}, '
+            f'{existing_row["Notes"]}, '
+            f'{existing_row["Labels"]}'
         )
         print(
-            f'New: {new_df.loc[new_index, "date"]}: '
-            f'{new_df.loc[new_index, "category_name"]}, '
-            f'{new_df.loc[new_index, "payee"]}, '
-            f'{new_df.loc[new_index, "amount"]}, '
-            f'{new_df.loc[new_index, "notes"]}, '
-            f"{new_values[-1]}"
+            f'New: {new_row["date"]}: '
+            f'{new_row["category_name"]}, '
+            f'{new_row["payee"]}, '
+            f'{new_row["amount"]}, '
+            f'{new_row["notes"]}, '
+            f"{new_fields[-1]}"
         )
         response = ""
         while response.lower() != "n" and response.lower() != "o":
             response = input("Which one is right (o/n): ")
         if response == "n":
             # update the existing data with new values
-            existing_df.at[existing_index, "Description"] = new_values[0]
-            existing_df.at[existing_index, "Category"] = new_values[1]
-            existing_df.at[existing_index, "Notes"] = new_values[2]
-            existing_df.at[existing_index, "Labels"] = new_values[3]
+            existing_df.at[existing_index, "Description"] = new_fields[0]
+            existing_df.at[existing_index, "Category"] = new_fields[1]
+            existing_df.at[existing_index, "Notes"] = new_fields[2]
+            existing_df.at[existing_index, "Labels"] = new_fields[3]
+            existing_values[existing_index] = new_fields
         else:
             # update the lunchmoney transaction with the new values
-            lunchmoney_update_transaction(
-                new_df.loc[new_index, "id"],
+            queue_transaction_update(
+                pending_updates,
+                new_row["id"],
                 {
-                    "payee": existing_values[0],
-                    "category_id": get_category_id_by_name(existing_values[1]),
-                    "notes": existing_values[2],
-                    "tags": existing_values[3].split(" "),
+                    "payee": existing_fields[0],
+                    "category_id": get_category_id_by_name(existing_fields[1]),
+                    "notes": existing_fields[2],
+                    "tags": existing_fields[3].split(" "),
                 },
             )
 
-    # Drop the duplicate from the dataframe of new transactions
-    new_df.drop(new_index, inplace=True)
+    # Remember to drop the duplicate from the dataframe of new transactions
+    duplicate_indices.append(new_index)
 
 
-def normalize_empty_values(values_list):
-    # Replace NaN, None, and empty lists with an empty string
-    empty = ""
-    return [
-        (
-            empty
-            if (isinstance(value, list) and len(value) == 0)
-            or pd.isna(value)
-            or value is None
-            else value
-        )
-        for value in values_list
-    ]
+def values_by_index(df):
+    """Returns a dict that maps each index in df to a tuple of the values in its row
+    so that they can be looked up and compared without going through pandas
+    """
+    return dict(zip(df.index, df.itertuples(index=False, name=None)))
+
+
+def normalize_empty_values(df):
+    """Returns a copy of df with NaN and None replaced with an empty string,
+    checking every cell at once rather than one value at a time
+    """
+    df = df.astype(object)
+    return df.where(df.notna(), "")
 
 
 def get_existing_transactions(input_path, input_file, date_format):
@@ -152,8 +227,12 @@ def get_existing_transactions(input_path, input_file, date_format):
     Reads the data from MINT_CSV_FILE and returns the dataframe.
     """
     mint_csv_path = os.path.join(input_path, input_file)
-    mint_df = pd.read_csv(mint_csv_path)
-    mint_df["Date"] = pd.to_datetime(mint_df["Date"])
+    mint_df = pd.read_csv(mint_csv_path, dtype=MINT_CSV_DTYPES)
+    try:
+        mint_df["Date"] = pd.to_datetime(mint_df["Date"], format=date_format)
+    except ValueError:
+        # The file doesn't match MINT_DATE_FORMAT, let pandas infer the format
+        mint_df["Date"] = pd.to_datetime(mint_df["Date"])
     return mint_df
 
 
@@ -176,14 +255,24 @@ def get_new_lunchmoney_transactions(existing_df, lookback_days):
     )
     print(f"Fetched {len(new_transactions_df)} new transactions from LunchMoney.")
 
+    # Join the tag names once, they are compared and written as a string
+    new_transactions_df["tag_str"] = new_transactions_df["tags"].map(
+        lambda tags: " ".join([tag["name"] for tag in tags or []])
+    )
+    # The account and category names repeat a lot, store them as categoricals
+    new_transactions_df = new_transactions_df.astype(
+        {"category_name": "category", "account_display_name": "category"}
+    )
+
     return new_transactions_df
 
 
 def exit_if_transactions_not_ready(df):
     """Exits if there are any transactions that still need to be cleared or categorized"""
-    unreviewed = df[df.status == "uncleared"]
-    if len(unreviewed) > 0:
-        print(f"There are {len(unreviewed)} transactions that need to be reviewed.")
+    # Count the transactions without building a dataframe of them
+    unreviewed = (df["status"].to_numpy() == "uncleared").sum()
+    if unreviewed:
+        print(f"There are {unreviewed} transactions that need to be reviewed.")
         print(
             "Please visit\n"
             "https://my.lunchmoney.app/transactions/2024/02?match=all&status=unreviewed&time=all\n"
@@ -206,46 +295,34 @@ def merge_and_output(existing_df, to_add_df, output_path, output_file):
         print("No new transactions to add.")
         return
     print(f"Will add {len(to_add_df)} new transactions to {output_path}/{output_file}")
-    # Convert the lunchmoney transactions to mint format
-    to_add_mint_format = to_add_df[
-        [
-            "date",
-            "payee",
-            "amount",
-            "category_name",
-            "account_display_name",
-            "tags",
-            "notes",
-        ]
-    ].rename(
-        columns={
-            "date": "Date",
-            "payee": "Description",
-            "amount": "Amount",
-            "category_name": "Category",
-            "account_display_name": "Account Name",
-            "tags": "Labels",
-            "notes": "Notes",
-        }
-    )
-    to_add_mint_format.insert(2, "Original Description", "")
-    to_add_mint_format.insert(
-        4,
-        "Transaction Type",
-        to_add_mint_format["Amount"].apply(lambda x: "debit" if x > 0 else "credit"),
-    )
-    to_add_mint_format["Amount"] = to_add_mint_format["Amount"].abs()
-    to_add_mint_format["Labels"] = to_add_mint_format["Labels"].apply(
-        lambda x: " ".join([tag["name"] for tag in x]) if x else ""
+    # Convert the lunchmoney transactions to mint format, which has unsigned
+    # amounts with the sign in the Transaction Type
+    amount = to_add_df["amount"].to_numpy(dtype=np.float64)
+    to_add_mint_format = pd.DataFrame(
+        {
+            "Date": to_add_df["date"],
+            "Description": to_add_df["payee"],
+            "Original Description": "",
+            "Amount": np.abs(amount),
+            "Transaction Type": np.where(amount > 0, "debit", "credit"),
+            "Category": to_add_df["category_name"],
+            "Account Name": to_add_df["account_display_name"],
+            "Labels": to_add_df["tag_str"],
+            "Notes": to_add_df["notes"],
+        },
+        index=to_add_df.index,
     )
 
-    # Merge the dbs and write out the new total transactions file
-    new_total_df = pd.concat([existing_df, to_add_mint_format])
-    new_total_df = new_total_df.sort_values(by="Date", ascending=False)
+    # Merge the dbs and write out the new total transactions file.  The index isn't
+    # written so don't build one for the merged rows, and sort the merged frame in
+    # place rather than keeping both the unsorted and sorted copies around
+    new_total_df = pd.concat([existing_df, to_add_mint_format], ignore_index=True)
+    new_total_df.sort_values(by="Date", ascending=False, inplace=True)
     new_total_df.to_csv(
         os.path.join(output_path, output_file),
         index=False,
         date_format=MINT_DATE_FORMAT,
+        chunksize=MERGED_CSV_CHUNK_ROWS,
     )
 
 
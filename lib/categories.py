@@ -11,39 +11,51 @@
    client for API access.
 """
 
-from lunchable import LunchMoney
+from lib import lm_client
 from config import lunchmoney_config as lmc
 
 private_lunch = None
 categories = None
+category_ids_by_name = None
 
 
 def init_lunchable(token):
     global private_lunch
     if private_lunch is None:
-        private_lunch = LunchMoney(access_token=token)
+        private_lunch = lm_client.init_lunchable(token)
     return private_lunch
 
 
 def get_categories(lunch=None):
     """If it hasn't been done yet, get's the categories from lunchmoney
-    and stores them in the global variable categories
+    and stores them in the global variable categories, along with a dict
+    that maps each category name to its id
     """
-    global categories
+    global categories, category_ids_by_name
     if categories is None:
         if lunch is None:
             lunch = init_lunchable(lmc.LUNCHMONEY_API_TOKEN)
         categories = lunch.get_categories()
+        category_ids_by_name = {}
+        for category in categories:
+            # If two categories share a name the first one wins
+            category_ids_by_name.setdefault(category.name, category.id)
     return categories
 
 
 def get_category_id_by_name(name, lunch=None):
     """Returns the category id for the category with the specified name"""
-    categories = get_categories(lunch)
-    category = next(
-        (category for category in categories if category.name == name), None
-    )
-    return category.id if category else None
+    get_categories(lunch)
+    return category_ids_by_name.get(name)
+
+
+def clear_categories_cache():
+    """Forgets the fetched categories so that they are fetched again the next
+    time they are needed, called after a category or group is changed
+    """
+    global categories, category_ids_by_name
+    categories = None
+    category_ids_by_name = None
 
 
 def update_category(
@@ -62,7 +74,7 @@ def update_category(
     """
     if lunch is None:
         lunch = init_lunchable(lmc.LUNCHMONEY_API_TOKEN)
-    return lunch.update_category(
+    result = lunch.update_category(
         id,
         name=name,
         description=description,
@@ -72,6 +84,8 @@ def update_category(
         group_id=group_id,
         archived=archived,
     )
+    clear_categories_cache()
+    return result
 
 
 def create_category_group(
@@ -87,7 +101,7 @@ def create_category_group(
     """Creates a new category group"""
     if lunch is None:
         lunch = init_lunchable(lmc.LUNCHMONEY_API_TOKEN)
-    return lunch.insert_category_group(
+    result = lunch.insert_category_group(
         name,
         description=description,
         is_income=is_income,
@@ -96,3 +110,5 @@ def create_category_group(
         category_ids=category_ids,
         new_categories=None,
     )
+    clear_categories_cache()
+    return result
@@ -4,12 +4,19 @@
     for potential duplicates.   When candidates are found they are presented 
     interactively to the user
 """
+import numpy as np
 import pandas as pd
+from lib.find_duplicates import find_duplicate_candidate_positions
 from lib.transactions import (
     lunchmoney_update_transaction,
     lunchmoney_delete_transaction,
+    lunchmoney_update_transactions,
+    queue_transaction_update,
 )
 
+# Transactions with any of these tags are not offered as duplicates of each other
+NOT_DUPLICATE_TAGS = frozenset({"Not-Duplicate", "SkipDupCheck"})
+
 
 def find_duplicate_transactions(
     df,
@@ -22,119 +29,177 @@ def find_duplicate_transactions(
 
     This approach makes it easier to pull up the financial institutions website
     to validate suspected duplicate transactions
+
+    The updates to the transactions that are deleted or tagged as non duplicates
+    are queued while the user is prompted and made together at the end, or when
+    the search is interrupted
     """
     ids_to_delete = []
-    # To facilitate checking break the df into chunks based on account name
-    for account_name in df["account_display_name"].unique():
-        # Sort all the rows for each account by date, and make a copy to check for dups
-        df_to_search = df[df["account_display_name"] == account_name].sort_values(
-            by="date", ascending=False
-        )
-        ids_to_delete = find_duplicates_for_one_account(
-            df_to_search, lookback_days, ids_to_delete
-        )
-
+    pending_updates = {}
+    # Check the tags of each transaction once, and group the accounts by their
+    # categorical codes rather than by comparing the names.  The categories are
+    # in the order the accounts first appear, the order they are searched in
+    accounts = df["account_display_name"]
+    df = df.assign(
+        not_duplicate=df["tags"].map(has_not_duplicate_tag).astype(bool),
+        account_display_name=pd.Categorical(
+            accounts, categories=accounts.dropna().drop_duplicates().tolist()
+        ),
+    )
+    # Sort all the rows by date once to check for dups, grouping keeps each
+    # account's rows in that order
+    df = df.sort_values(by="date", ascending=False, kind="stable")
+    try:
+        # To facilitate checking break the df into chunks based on account name
+        for _, df_to_search in df.groupby(
+            "account_display_name", sort=True, observed=True
+        ):
+            ids_to_delete = find_duplicates_for_one_account(
+                df_to_search, lookback_days, ids_to_delete, pending_updates
+            )
+    finally:
+        # Make the updates for the answers already given even if the user stops
+        # partway through with Ctrl-C, or something goes wrong
+        lunchmoney_update_transactions(pending_updates)
     return ids_to_delete
 
 
-def find_duplicates_for_one_account(df, lookback_days, ids_to_delete):
+def has_not_duplicate_tag(tags):
+    """Returns True if any of the tags is one of the NOT_DUPLICATE_TAGS"""
+    return any(tag["name"] in NOT_DUPLICATE_TAGS for tag in tags or [])
+
+
+def find_same_amount_candidates(df, lookback_days):
+    """Returns a pair of int arrays (row_pos, match_pos) with the positions of every
+    pair of rows in df that have the same amount, where the match comes after the
+    row and is no more than lookback_days older.  The pairs are sorted by row_pos
+    and then match_pos.
+
+    df must be sorted by descending date.  Rows are only compared with the rows
+    after them, so each pair is only offered once
+    """
+    amount_codes, _ = pd.factorize(df["amount"])
+    days = df["date"].to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    valid = np.flatnonzero((amount_codes >= 0) & ~np.isnat(days))
+    day_numbers = days[valid].astype(np.int64)
+    # A self join on amount, looking back from each row
+    row_idx, match_idx = find_duplicate_candidate_positions(
+        np.zeros(len(valid), dtype=np.int64),
+        amount_codes[valid].astype(np.int64),
+        day_numbers,
+        np.zeros(len(valid), dtype=np.int64),
+        amount_codes[valid].astype(np.int64),
+        day_numbers,
+        lookback_days=lookback_days,
+        lookahead_days=0,
+    )
+    row_pos, match_pos = valid[row_idx], valid[match_idx]
+    later = match_pos > row_pos
+    return (row_pos[later], match_pos[later])
+
+
+def find_duplicates_for_one_account(
+    df, lookback_days, ids_to_delete, pending_updates=None
+):
     """Look for duplicates in a dataframe of transactions
     If found ask user to disambiguate, tagging non-duplicates, and
-    deleting duplicates
+    deleting duplicates.  If pending_updates is passed the API updates are
+    queued in it instead of being made as the user responds
 
-    Note that it is assumed that all transactions are for the same account
+    Note that it is assumed that all transactions are for the same account, and
+    that they are sorted by descending date.  All the candidate duplicates are
+    found up front by find_same_amount_candidates
     """  # Validate: len(df_to_search["account_display_name"].unique())
-    deleted_indices = []
-    df_copy = df.copy()
-    for index, row in df.iterrows():
+    row_pos, candidate_pos = find_same_amount_candidates(df, lookback_days)
+    # The candidates for the row at pos are candidate_pos[starts[pos]:ends[pos]]
+    starts = np.searchsorted(row_pos, np.arange(len(df)), side="left")
+    ends = np.searchsorted(row_pos, np.arange(len(df)), side="right")
+    deleted = np.zeros(len(df), dtype=bool)
+    # Rows tagged as not a duplicate during this run are added to the copy
+    not_duplicate = df["not_duplicate"].to_numpy(dtype=bool, copy=True)
+
+    for pos, index in enumerate(df.index):
         # Skip analysis if the row was already declared a duplciate
-        if index in deleted_indices:
+        if deleted[pos]:
+            continue
+        # Transactions after this one with the same amount in the date window
+        match_pos = candidate_pos[starts[pos]:ends[pos]]
+        match_pos = match_pos[~deleted[match_pos]]
+        if len(match_pos) == 0:
             continue
-        df_copy.drop(index, inplace=True)
-        # Find transactions with the same amount in the same date window
-        matches = df_copy[
-            (df_copy["amount"] == row["amount"])
-            # We assume that the data passed into this function is for a single acct
-            # & (df_copy["account_display_name"] == row["account_display_name"])
-            & (df_copy["date"] >= row.date - pd.Timedelta(days=lookback_days))
-        ]
-
         # Drop matches that have already been marked Not-Duplicate
-        if len(matches) > 0:
-            not_duplicate_tags = {"Not-Duplicate", "SkipDupCheck"}
-            if any(tag["name"] in not_duplicate_tags for tag in row["tags"]):
-                matches = matches[
-                    ~matches["tags"].apply(
-                        lambda tags: any(
-                            tag["name"] in not_duplicate_tags for tag in tags
-                        )
-                    )
-                ]
-                if len(matches) <= 0:
-                    continue
-
-            # Combine row and matches to interactively check with the user
-            new_row = row.to_frame().T
-            matches = pd.concat([new_row, matches])
-
-            # Convert datetimes to printable date format
-            matches["date"] = matches["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
-            # Convert list of tag objects to a string of comma seperated tag names
-            matches["tags"] = matches["tags"].apply(
-                lambda tags: ",".join([tag["name"] for tag in tags])
+        if not_duplicate[pos]:
+            match_pos = match_pos[~not_duplicate[match_pos]]
+            if len(match_pos) <= 0:
+                continue
+        # Take the row and its matches in one go to interactively check with the
+        # user, as a copy since the columns are reformatted for printing
+        matches = df.iloc[np.concatenate(([pos], match_pos))].copy()
+
+        # Convert datetimes to printable date format
+        matches["date"] = matches["date"].dt.strftime("%Y-%m-%d")
+        # Print each amount as it is, not padded to the same number of decimals
+        matches["amount"] = matches["amount"].astype(object)
+        # Convert list of tag objects to a string of comma seperated tag names
+        matches["tags"] = matches["tags"].apply(
+            lambda tags: ",".join([tag["name"] for tag in tags or []])
+        )
+        print("\nPotential duplicate transactions:")
+        while len(matches) > 1:
+            print(
+                matches[
+                    [
+                        "date",
+                        "category_name",
+                        "payee",
+                        "amount",
+                        "account_display_name",
+                        "notes",
+                        "tags",
+                    ]
+                ].to_string(index=True)
             )
-            print("\nPotential duplicate transactions:")
-            while len(matches) > 1:
-                print(
-                    matches[
-                        [
-                            "date",
-                            "category_name",
-                            "payee",
-                            "amount",
-                            "account_display_name",
-                            "notes",
-                            "tags",
-                        ]
-                    ].to_string(index=True)
+            need_user_input = True
+            while need_user_input:
+                user_response = input(
+                    "Please enter the index of any duplicate or hit enter if "
+                    "there are no duplicates: "
                 )
-                need_user_input = True
-                while need_user_input:
-                    user_response = input(
-                        "Please enter the index of any duplicate or hit enter if "
-                        "there are no duplicates: "
+                try:
+                    # If we got a numeric input delete the duplicate transaction
+                    dup_index = int(user_response)
+                    if dup_index != index and dup_index not in matches.index:
+                        print("Invalid entry try again.")
+                        continue
+                    print("Will delete this duplicate")
+                    id_to_delete = matches.loc[dup_index, "id"]
+                    ids_to_delete.append(id_to_delete)
+                    lunchmoney_delete_transaction(
+                        id_to_delete, matches.loc[dup_index, "tags"], pending_updates
+                    )
+                    if dup_index != index:
+                        # Don't analyze this transaction when we get to it
+                        deleted[df.index.get_loc(dup_index)] = True
+                    matches.drop(dup_index, inplace=True)
+                    need_user_input = False
+                except ValueError:
+                    # Add "Not-Duplicate" tag to transactions
+                    df = interactive_tag_non_dup(
+                        matches, df, pending_updates=pending_updates
                     )
-                    try:
-                        # If we got a numeric input delete the duplicate transaction
-                        dup_index = int(user_response)
-                        if dup_index != index and dup_index not in matches.index:
-                            print("Invalid entry try again.")
-                            continue
-                        print("Will delete this duplicate")
-                        id_to_delete = matches.loc[dup_index, "id"]
-                        ids_to_delete.append(id_to_delete)
-                        lunchmoney_delete_transaction(
-                            id_to_delete, matches.loc[dup_index, "tags"]
-                        )
-                        if dup_index != index:
-                            # Don't analyze this transaction when iterrate to it
-                            deleted_indices.append(dup_index)
-                            df_copy.drop(dup_index, inplace=True)
-                        matches.drop(dup_index, inplace=True)
-                        need_user_input = False
-                    except ValueError:
-                        # Add "Not-Duplicate" tag to transactions
-                        (df, df_copy) = interactive_tag_non_dup(matches, df, df_copy)
-                        matches = pd.DataFrame()
-                        need_user_input = False
+                    not_duplicate[df.index.get_indexer(matches.index)] = True
+                    matches = pd.DataFrame()
+                    need_user_input = False
     return ids_to_delete
 
 
-def interactive_tag_non_dup(matches, loc_df1, loc_df2):
+def interactive_tag_non_dup(matches, df, pending_updates=None):
     """Tags each transaction as the dataframe with "Not-Duplicate
     Interactively offers opportunity to update Payee or Notes field
-    Updates transaction date in Lunch Money via API
-    Updates in mem copies of transactions for further processing
+    Updates transaction date in Lunch Money via API, or queues the update in
+    pending_updates if it is passed
+    Updates the in mem copy of the transactions in df for further processing
+    and returns it
     """
     for index, match in matches.iterrows():
         update_obj = {}
@@ -159,16 +224,16 @@ def interactive_tag_non_dup(matches, loc_df1, loc_df2):
                     ]
             else:
                 update_obj["tags"] = ["Not-Duplicate"]
-        if update_obj:
+        if update_obj and pending_updates is not None:
+            queue_transaction_update(pending_updates, match["id"], update_obj)
+        elif update_obj:
             lunchmoney_update_transaction(
                 match["id"],
                 update_obj,
             )
 
-        # Update local data stores so we don't do these again
-        if index in loc_df1.index:
-            loc_df1.loc[index, "tags"].append({"name": "SkipDupCheck"})
-        if index in loc_df2.index:
-            loc_df2.loc[index, "tags"].append({"name": "SkipDupCheck"})
+        # Update the local data so we don't do these again
+        if index in df.index:
+            df.loc[index, "tags"].append({"name": "SkipDupCheck"})
 
-    return (loc_df1, loc_df2)
+    return df
@@ -4,54 +4,294 @@
    in two dataframes
 """
 
+import numpy as np
 import pandas as pd
+from config import lunchmoney_config as lmc
 
+# When several candidates match, the best scoring one is picked without asking if
+# its score beats all the others by at least this much.  Older configs won't have
+# it, default to picking clear winners.  Set it to None to always ask
+AUTO_MATCH_MARGIN = getattr(lmc, "AUTO_MATCH_MARGIN", 0.5)
+# How much each day between two transactions lowers a candidate's score
+DAY_PENALTY = 0.05
 
-def filter_matches_by_account(matches, account, acct_field_name, acct_name_df):
-    """ This function takes a dataframe of possible transaction the old_df
-        passed to find_duplicates that match the date range and amount of the current
-        transaction being analyzed in new_df
 
-        It removes potential matches that don't have the same account name, or
-        an account name listed as a synonym in account_name_map.csv
+def normalize_account_names(names):
+    """Returns a Series of account names that are lower cased and stripped of
+    leading/trailing white space so that they can be compared to each other.
+    There are only a few distinct account names, so each is normalized once
     """
-    account = account.strip()
-    if acct_name_df is not None and account in acct_name_df.columns:
-        processed_matches = matches[acct_field_name].str.lower().str.strip()
-        processed_acct_names = acct_name_df[account].str.lower().str.strip().unique()
-        return matches[processed_matches.isin(processed_acct_names)]
+    codes, uniques = pd.factorize(names)
+    normalized = pd.Index(uniques).str.lower().str.strip()
+    return pd.Series(
+        normalized.take(codes, allow_fill=True, fill_value=np.nan), index=names.index
+    )
+
+
+def normalize_payees(payees):
+    """Returns a Series of payees that are lower cased with everything but letters,
+    digits and spaces removed so that they can be compared for similarity
+    """
+    return (
+        payees.fillna("")
+        .astype(str)
+        .str.lower()
+        .str.replace(r"[^a-z0-9 ]", "", regex=True)
+        .str.strip()
+    )
+
+
+def get_payee_tokens(new_payees, old_payees):
+    """Returns a pair of dicts that map the index of each of the new and old payees
+    to a frozenset of integer token ids.  The payees are split into words once and
+    each word is numbered across both series, so payees are compared with cheap
+    integer set operations rather than string comparisons
+    """
+    payees = pd.concat([new_payees, old_payees], ignore_index=True)
+    words = payees.str.split().explode()
+    token_ids = pd.factorize(words)[0]
+    # explode keeps the words of each payee together and in order, so the ids of
+    # the payee at each position are a slice between two bounds
+    has_word = token_ids >= 0
+    rows = words.index.to_numpy()[has_word]
+    bounds = np.searchsorted(rows, np.arange(len(payees) + 1)).tolist()
+    token_ids = token_ids[has_word].tolist()
+    tokens = [
+        frozenset(token_ids[start:end]) for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    return (
+        dict(zip(new_payees.index, tokens[: len(new_payees)])),
+        dict(zip(old_payees.index, tokens[len(new_payees):])),
+    )
+
+
+def payee_similarity(tokens, other_tokens):
+    """Returns the Jaccard similarity of two sets of payee tokens"""
+    if not tokens or not other_tokens:
+        return 0.0
+    return len(tokens & other_tokens) / len(tokens | other_tokens)
+
+
+def pick_clear_winner(similarity, days_apart):
+    """Scores each candidate by the similarity of its payee less DAY_PENALTY for
+    each day between it and the transaction being matched.
+
+    Returns: the position of the best scoring candidate if it beats every other
+    candidate by at least AUTO_MATCH_MARGIN, otherwise None so the user is asked
+    """
+    if AUTO_MATCH_MARGIN is None or len(similarity) < 2:
+        return None
+    scores = np.asarray(similarity) - DAY_PENALTY * np.asarray(days_apart)
+    best, runner_up = np.argsort(scores, kind="stable")[[-1, -2]]
+    if scores[best] - scores[runner_up] >= AUTO_MATCH_MARGIN:
+        return best
+    return None
+
+
+def get_account_synonyms(accounts, acct_name_df):
+    """Returns a dict that maps each unique account name in accounts to the list
+    of normalized account names that it may be matched with in the old data.
+
+    An account matches an old account with the same name, or an account name
+    listed as a synonym in account_name_map.csv
+    """
+    synonyms = {}
+    for account in accounts.unique():
+        if not isinstance(account, str):
+            synonyms[account] = []
+            continue
+        stripped = account.strip()
+        if acct_name_df is not None and stripped in acct_name_df.columns:
+            names = normalize_account_names(acct_name_df[stripped]).dropna()
+            synonyms[account] = names.unique().tolist()
+        else:
+            synonyms[account] = [stripped.lower()]
+    return synonyms
+
+
+def to_amount_keys(amounts, is_debit=None):
+    """Returns a float array of amounts as whole cents so that they can be compared
+    exactly.  Missing amounts are NaN.
+
+    Mint amounts are unsigned with the sign in the "Transaction Type", so when
+    is_debit is passed the key is the absolute amount in cents, doubled, plus one for
+    debits.  This keeps a zero debit from matching a zero credit
+    """
+    cents = np.round(np.asarray(amounts, dtype=np.float64) * 100)
+    if is_debit is None:
+        return cents
+    return np.abs(cents) * 2 + is_debit
+
+
+def find_duplicate_candidate_positions(
+    new_account,
+    new_amount,
+    new_day,
+    old_account,
+    old_amount,
+    old_day,
+    lookback_days=0,
+    lookahead_days=7,
+):
+    """Returns a pair of int arrays (new_idx, old_idx) with the positions in the
+    new_* and old_* arrays of every candidate duplicate, sorted by new_idx and then
+    old_idx.
+
+    A candidate has the same account code and amount key, and an old_day no more
+    than lookback_days before or lookahead_days after the new_day.  All of the
+    arrays are int64 and must not contain missing values.
+
+    The old rows are sorted once by (account, amount, day) so the candidates for
+    each new row are found with a binary search for the ends of its date window,
+    and only the pairs inside a window are ever materialized
+    """
+    # Give every (account, amount) block an id, and build a single sortable key of
+    # block and day, offset so a date window can never spill into another block.
+    # The block ids come from hash joins on each key and then on the pair of codes,
+    # which is much cheaper than sorting the pairs
+    account_codes, _ = pd.factorize(np.concatenate([new_account, old_account]))
+    amount_codes, _ = pd.factorize(np.concatenate([new_amount, old_amount]))
+    block_ids, _ = pd.factorize(
+        account_codes.astype(np.int64) * (amount_codes.max(initial=0) + 1)
+        + amount_codes
+    )
+    first_day = min(new_day.min(initial=0), old_day.min(initial=0))
+    last_day = max(new_day.max(initial=0), old_day.max(initial=0))
+    span = last_day - first_day + lookback_days + lookahead_days + 1
+    new_key = block_ids[: len(new_day)] * span + (new_day - first_day + lookback_days)
+    old_key = block_ids[len(new_day):] * span + (old_day - first_day + lookback_days)
+
+    # The candidates for each new row are a contiguous slice of the sorted old keys
+    order = np.argsort(old_key, kind="stable")
+    sorted_key = old_key[order]
+    lo = np.searchsorted(sorted_key, new_key - lookback_days, side="left")
+    hi = np.searchsorted(sorted_key, new_key + lookahead_days, side="right")
+
+    # Expand the slices into pairs without a python loop
+    counts = hi - lo
+    new_idx = np.repeat(np.arange(len(new_day)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    old_idx = order[np.repeat(lo, counts) + offsets]
+    by_new_then_old = np.lexsort((old_idx, new_idx))
+    return (new_idx[by_new_then_old], old_idx[by_new_then_old])
+
+
+def find_duplicate_candidates(
+    new_df,
+    old_df,
+    old_fields,
+    acct_name_df=None,
+    lookback_days=0,
+    lookahead_days=7,
+    old_type="lunchmoney",
+):
+    """Returns a pair of int arrays (new_pos, old_pos) with the positions of every
+    pair of rows in new_df and old_df that are candidate duplicates, sorted by
+    new_pos and then old_pos.
+
+    Rather than scanning old_df once for each row in new_df, both dataframes are
+    reduced to contiguous int arrays of their key columns (account code, amount
+    in cents and day number) which are passed to
+    find_duplicate_candidate_positions, so no pandas row access happens while
+    matching.  All the accounts are searched in the same pass, so there is nothing
+    to gain from splitting the search up by account and running it in parallel
+    """
+    old_date_field, old_amount_field, old_account_field = old_fields
+
+    # Each new row can match any of the synonyms for its account
+    synonyms = get_account_synonyms(new_df["account_display_name"], acct_name_df)
+    # Map from object values, mapping a categorical would build list categories
+    new_accounts = (
+        new_df["account_display_name"]
+        .astype(object)
+        .map(synonyms)
+        .reset_index(drop=True)
+        .explode()
+    )
+    new_pos = new_accounts.index.to_numpy()
+    old_pos = np.arange(len(old_df))
+
+    # Factorize the new and old account names together so equal names share a code
+    account_codes, _ = pd.factorize(
+        np.concatenate(
+            [
+                new_accounts.to_numpy(dtype=object),
+                normalize_account_names(old_df[old_account_field]).to_numpy(
+                    dtype=object
+                ),
+            ]
+        )
+    )
+    new_account = account_codes[: len(new_pos)]
+    old_account = account_codes[len(new_pos):]
+
+    if old_type == "mint":
+        new_amounts = new_df["amount"].to_numpy(dtype=np.float64)
+        new_amount = to_amount_keys(new_amounts, new_amounts > 0)[new_pos]
+        transaction_type = old_df["Transaction Type"].map({"debit": 1, "credit": 0})
+        old_amount = to_amount_keys(
+            old_df[old_amount_field], transaction_type.to_numpy(dtype=np.float64)
+        )
     else:
-        return matches[
-            matches["Account Name"].str.lower().str.strip() == account.lower()
-        ]
+        new_amount = to_amount_keys(new_df["amount"])[new_pos]
+        old_amount = to_amount_keys(old_df[old_amount_field])
+    new_dates = new_df["date"].to_numpy(dtype="datetime64[ns]")[new_pos]
+    old_dates = old_df[old_date_field].to_numpy(dtype="datetime64[ns]")
+
+    # Missing keys never match anything, so keep them out of the arrays
+    new_valid = (new_account >= 0) & ~np.isnan(new_amount) & ~np.isnat(new_dates)
+    old_valid = (old_account >= 0) & ~np.isnan(old_amount) & ~np.isnat(old_dates)
+    new_pos, old_pos = new_pos[new_valid], old_pos[old_valid]
+
+    new_idx, old_idx = find_duplicate_candidate_positions(
+        new_account[new_valid],
+        new_amount[new_valid].astype(np.int64),
+        new_dates[new_valid].astype("datetime64[D]").astype(np.int64),
+        old_account[old_valid],
+        old_amount[old_valid].astype(np.int64),
+        old_dates[old_valid].astype("datetime64[D]").astype(np.int64),
+        lookback_days=lookback_days,
+        lookahead_days=lookahead_days,
+    )
+    # The pairs for a new row with several synonyms are interleaved, and could
+    # repeat.  Combine each pair into a single key so they are sorted and any
+    # repeats dropped in one pass, without building a dataframe
+    pair_keys = np.unique(new_pos[new_idx] * len(old_df) + old_pos[old_idx])
+    return np.divmod(pair_keys, max(len(old_df), 1))
 
 
 def find_duplicates(
     new_df,
     old_df,
-    update_fn,
+    update_fn=None,
     acct_name_df=None,
     lookback_days=0,
     lookahead_days=7,
     old_type="lunchmoney",
 ):
     """
-        This iterates through each transaction in the new_df and looks for
-        potential matches in old_df.
-        The initial test is to find transactions with the same amount and a date
-        in a range of lookahead_days later or lookback_days earlier than the source
-        The list of potential matches is then filtered to find matching account names,
-        or account names in a list of synonyms defined in account_name_map.py
+        This looks for potential matches in old_df for each transaction in new_df.
+        A potential match has the same amount and a date in a range of
+        lookahead_days later or lookback_days earlier than the source, in an account
+        with the same name, or an account name in a list of synonyms defined in
+        account_name_map.py.  All potential matches are found up front with
+        find_duplicate_candidates.
         If more than one potential match is found, the user is prompted in the terminal
-        to select one.
+        to select one, unless pick_clear_winner finds one that is clearly the best.
+        The potential matches are listed in order of how similar their payee is to
+        the one being examined, and the most similar is the default.  An index that
+        isn't one of the listed matches is rejected with "Invalid entry try again."
+        and the user is asked again.
         Once a single match is found, the update_fn is called which may write
-        additional information into the new and old dataframes.
+        additional information into the new and old dataframes, or if there is no
+        update_fn the positions of the matching rows are recorded.
         If no potential match is found the word "Investigate" is written into the
         "action" colum for the row being examined.
 
         Required Parameters:
         new_df - a dataframe of LuncMoney transactions returned via the API
         old_df - a dataframe of LunchMoney or Mint exported transactions
+        Optional Parameters:
         update_fn - a function that is called when a potential duplicate transaction
         is found.  This function is passed, the new and old dataframes, the indices
         to the rows of the potential matches, the transaction id of the row being
@@ -59,9 +299,10 @@ def find_duplicates(
         is mint data, the index of the matching row
 
         The updated new_df and old_df are returned, afer all rows in new_df have
-        been examined
+        been examined.  If no update_fn is passed, a third value is returned, an
+        int array of shape (K, 2) with the positions in new_df and old_df of each
+        matching pair, so the caller can update both dataframes in one pass
     """
-    old_df_copy = old_df.copy()
     # Set the column names to check depending on if the old_df came from
     # lunchmoney or mint
     if old_type == "lunchmoney":
@@ -77,97 +318,165 @@ def find_duplicates(
     else:
         raise ValueError('old_type must be "lunchmoney" or "mint')
 
-    # Iterate through each row in new_df to try to find a matching transaction in old_df
-    # If found update the transaction info in both dataframes
-    for index, row in new_df.iterrows():
-        # Skip the row if a duplicate was already found
-        if "action" in row and (row.action == "Delete" or row.action == "Duplicate"):
-            continue
-        # Find matches where the date in old_csv is within 7 days and amt matches
-        if old_type == "lunchmoney":
-            amount = row["amount"]
+    candidate_new_pos, candidate_old_pos = find_duplicate_candidates(
+        new_df,
+        old_df,
+        (old_date_field, old_amount_field, old_account_field),
+        acct_name_df=acct_name_df,
+        lookback_days=lookback_days,
+        lookahead_days=lookahead_days,
+        old_type=old_type,
+    )
+    # The candidates for the row at new_pos are
+    # candidate_old_pos[starts[new_pos]:ends[new_pos]]
+    starts = np.searchsorted(candidate_new_pos, np.arange(len(new_df)), side="left")
+    ends = np.searchsorted(candidate_new_pos, np.arange(len(new_df)), side="right")
+
+    new_days = new_df["date"].to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    old_days = old_df[old_date_field].to_numpy(dtype="datetime64[ns]")
+    old_days = old_days.astype("datetime64[D]")
+
+    if "action" in new_df.columns:
+        already_matched = new_df["action"].isin(["Delete", "Duplicate"]).to_numpy()
+    else:
+        already_matched = np.zeros(len(new_df), dtype=bool)
+    counts = np.where(already_matched, -1, ends - starts)
+
+    # Payees are only compared when there are several matches, so only tokenize
+    # those of the rows with several candidates and of their candidates.  The
+    # tokens are looked up by position
+    several = np.repeat(counts > 1, ends - starts)
+    several_new_pos = np.flatnonzero(counts > 1)
+    several_old_pos = np.unique(candidate_old_pos[several])
+    new_tokens, old_tokens = get_payee_tokens(
+        normalize_payees(
+            new_df["payee"].iloc[several_new_pos].set_axis(several_new_pos)
+        ),
+        normalize_payees(
+            old_df[old_description_field]
+            .iloc[several_old_pos]
+            .set_axis(several_old_pos)
+        ),
+    )
+
+    # Rows without any candidates need investigating, mark them all at once
+    no_match = counts == 0
+    if no_match.any():
+        new_df.loc[new_df.index[no_match], "action"] = "Investigate"
+
+    # Old rows picked interactively are not offered as a match again, so rows
+    # with several candidates have to be resolved one row at a time, in order.
+    # A row with a single candidate that no such row could pick always matches
+    # it, so unless update_fn has to be called for each row in order those are
+    # recorded up front
+    consumed = np.zeros(len(old_df), dtype=bool)
+    to_resolve = counts > 0
+    match_pairs = []
+    vector_pairs = np.empty((0, 2), dtype=np.intp)
+    if update_fn is None:
+        contested = np.zeros(len(old_df), dtype=bool)
+        contested[candidate_old_pos[several]] = True
+        single = np.flatnonzero(counts == 1)
+        single_old_pos = candidate_old_pos[starts[single]]
+        uncontested = ~contested[single_old_pos]
+        vector_pairs = np.column_stack(
+            [single[uncontested], single_old_pos[uncontested]]
+        ).astype(np.intp)
+        to_resolve[single[uncontested]] = False
+
+    def record_match(new_pos, index, old_pos):
+        if update_fn is None:
+            match_pairs.append((new_pos, old_pos))
         else:
-            amount = abs(row["amount"])
-        matches = old_df_copy[
-            (
-                old_df_copy[old_date_field]
-                <= row.date + pd.Timedelta(days=lookahead_days)
-            )
-            & (
-                old_df_copy[old_date_field]
-                >= row.date - pd.Timedelta(days=lookback_days)
-            )
-            & (old_df_copy[old_amount_field] == amount)
-        ]
-        if old_type == "mint":
-            if row["amount"] > 0:
-                matches = matches[matches["Transaction Type"] == "debit"]
-            else:
-                matches = matches[matches["Transaction Type"] == "credit"]
-
-        if len(matches) > 0:
-            # Filter matches on account name and possible synonyms
-            matches = filter_matches_by_account(
-                matches, row.account_display_name, old_account_field, acct_name_df
+            update_fn(new_df, index, old_df, old_df.index[old_pos])
+
+    # Resolve the candidates for the remaining rows in new_df, in order, and
+    # update the transaction info in both dataframes
+    for new_pos in np.flatnonzero(to_resolve):
+        index = new_df.index[new_pos]
+        match_pos = candidate_old_pos[starts[new_pos]:ends[new_pos]]
+        match_pos = match_pos[~consumed[match_pos]]
+
+        if len(match_pos) == 1:
+            # Single match found, update the new and old dataframes
+            record_match(new_pos, index, match_pos[0])
+        elif len(match_pos) > 1:
+            # Order the candidates so the most similar payee is last, the default
+            similarity = np.array(
+                [
+                    payee_similarity(new_tokens[new_pos], old_tokens[pos])
+                    for pos in match_pos
+                ]
             )
-            if len(matches) == 1:
-                # Single match found, update the new and old dataframes
-                update_fn(
-                    new_df,
-                    index,
-                    old_df,
-                    matches.index[0],
-                )
-            elif len(matches) > 1:
-                # interactively check with the user
-                new_date = row.date.strftime("%Y-%m-%d")
+            order = np.argsort(similarity, kind="stable")
+            match_pos, similarity = match_pos[order], similarity[order]
+            row = new_df.loc[index]
+            new_date = row.date.strftime("%Y-%m-%d")
+            # Don't ask the user if one of the candidates is clearly the best
+            days_apart = np.abs((old_days[match_pos] - new_days[new_pos]).astype(int))
+            best = pick_clear_winner(similarity, days_apart)
+            if best is not None:
+                old_pos = match_pos[best]
                 print(
-                    f"Found {len(matches)} candidates to match {new_date}: "
-                    f"{row.amount} to {row.payee} from {row.account_display_name}:"
+                    f"Matched {new_date}: {row.amount} to {row.payee} from "
+                    f"{row.account_display_name} with {old_df.index[old_pos]}, "
+                    f"the best of {len(match_pos)} candidates"
                 )
-                matches = matches.copy()
-                # matches[old_date_field] = matches[old_date_field].dt.strftime(
-                #     "%Y-%m-%d"
-                # )
-                need_user_input = True
-                if old_type == "mint":
-                    matches["source"] = "mint"
-                print(
-                    matches[
-                        [
-                            old_date_field,
-                            old_amount_field,
-                            old_description_field,
-                            old_account_field,
-                            "source",
-                        ]
-                    ].to_string(index=True)
+                record_match(new_pos, index, old_pos)
+                consumed[old_pos] = True
+                continue
+            # interactively check with the user
+            print(
+                f"Found {len(match_pos)} candidates to match {new_date}: "
+                f"{row.amount} to {row.payee} from {row.account_display_name}:"
+            )
+            # Only take the columns that are shown from the candidate rows
+            display_fields = [
+                old_date_field,
+                old_amount_field,
+                old_description_field,
+                old_account_field,
+            ]
+            if old_type != "mint":
+                display_fields.append("source")
+            matches = old_df.iloc[match_pos, old_df.columns.get_indexer(display_fields)]
+            if old_type == "mint":
+                matches = matches.assign(source="mint")
+            need_user_input = True
+            print(matches.to_string(index=True))
+            # The user picks a candidate by its index, map each one to its
+            # position once rather than looking the answer up in old_df's index
+            positions_by_index = dict(zip(matches.index, match_pos))
+            default_index = matches.index[-1]
+            while need_user_input:
+                user_response = input(
+                    f"Please type in the index of the definition to use. "
+                    f"'n' for none ({default_index} default): "
                 )
-                while need_user_input:
-                    last_ind = len(matches) - 1
-                    user_response = input(
-                        f"Please type in the index of the definition to use. "
-                        f"'n' for none ({matches.index[last_ind]} default): "
-                    )
-                    try:
-                        # If we got a numeric input update the action and related_id
-                        if user_response == "":
-                            old_index = matches.index[last_ind]
-                        else:
-                            old_index = int(user_response)
-                        update_fn(
-                            new_df,
-                            index,
-                            old_df,
-                            old_index,
-                            )
-                        old_df_copy.drop(old_index, inplace=True)
-                        need_user_input = False
-                    except ValueError:
-                        print("Will treat this as a transaction missing from Mint")
-                        new_df.at[index, "action"] = "Investigate"
-                        need_user_input = False
-        if len(matches) <= 0:
+                try:
+                    # If we got a numeric input update the action and related_id
+                    if user_response == "":
+                        old_index = default_index
+                    else:
+                        old_index = int(user_response)
+                    if old_index not in positions_by_index:
+                        print("Invalid entry try again.")
+                        continue
+                    old_pos = positions_by_index[old_index]
+                    record_match(new_pos, index, old_pos)
+                    consumed[old_pos] = True
+                    need_user_input = False
+                except ValueError:
+                    print("Will treat this as a transaction missing from Mint")
+                    new_df.at[index, "action"] = "Investigate"
+                    need_user_input = False
+        else:
             new_df.at[index, "action"] = "Investigate"
 
+    if update_fn is None:
+        # Put the pairs back in the order the rows of new_df were examined
+        pairs = np.concatenate(
+            [np.array(match_pairs, dtype=np.intp).reshape(-1, 2), vector_pairs]
+        )
+        return (new_df, old_df, pairs[np.argsort(pairs[:, 0], kind="stable")])
     return (new_df, old_df)
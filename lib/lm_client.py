@@ -0,0 +1,64 @@
+"""lm_client.py
+
+   This module provides the lunchable client shared by all of the utilities.
+
+   Every request made by the client first takes a token from a single token bucket,
+   so all the LunchMoney API calls made by a script, from any thread, stay under
+   LM_API_REQUESTS_PER_SECOND.  Requests that are rejected with HTTP 429 (Too Many
+   Requests) anyway are retried after the delay in the Retry-After header, or with
+   exponential backoff if there isn't one.
+"""
+
+import functools
+import time
+from lunchable import LunchMoney
+from lib.rate_limiter import TokenBucket, LM_API_REQUESTS_PER_SECOND
+from config import lunchmoney_config as lmc
+
+# Number of times a request rejected for exceeding the rate limit is retried
+RATE_LIMIT_RETRIES = 3
+
+api_rate_limiter = TokenBucket(LM_API_REQUESTS_PER_SECOND)
+
+
+class RateLimitedLunchMoney(LunchMoney):
+    """A LunchMoney client that makes each request through api_rate_limiter"""
+
+    def request(self, method, url, **kwargs):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            api_rate_limiter.acquire()
+            response = super().request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                return response
+            time.sleep(retry_delay(response, attempt))
+
+
+def retry_delay(response, attempt):
+    """Returns the number of seconds to wait before retrying a request that got
+    the 429 response, from its Retry-After header if it has one
+    """
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return 2**attempt
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(token):
+    """Returns the rate limited lunchable client for token.  There is one client
+    per token, so its pool of keep-alive connections is reused by every call
+    """
+    lunch = RateLimitedLunchMoney(access_token=token)
+    # Create the httpx session now, rather than racing to create it on the first
+    # requests made from several threads at once
+    lunch.session
+    return lunch
+
+
+def init_lunchable(token=None):
+    """Returns the shared rate limited lunchable client, for the token in
+    lunchmoney_config.py if none is passed
+    """
+    if token is None:
+        token = lmc.LUNCHMONEY_API_TOKEN
+    return get_client(token)
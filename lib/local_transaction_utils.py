@@ -4,7 +4,10 @@
     files.
 """
 
-import numpy as np
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from datetime import datetime
 import sys
 import os
@@ -13,23 +16,30 @@ from config.lunchmoney_config import (
     COLS_TO_VALIDATE,
     DATE,
 )
-from lib.transactions import read_lm_transactions_csv
+from lib.transactions import (
+    read_lm_transactions_csv,
+    read_lm_transactions_parquet,
+    write_lm_transactions_parquet,
+)
 
 sys.path.append("..")
 
+# Extension of the parquet copy of a local csv file of transactions in CACHE_DIR,
+# which is named after the csv file and a hash of its absolute path
+LOCAL_TRANSACTIONS_CACHE_EXT = ".parquet"
+
 
 def validate_transactions(df, required_columns):
     """Ensure that required columns all have data in them"""
-    bad_col = None
-    for column in required_columns:
-        if column in df.index.names:
-            if np.isnan(df.index.get_level_values(column)).any():
-                bad_col = column
-                break
-        else:
-            if df[column].isnull().values.any():
-                bad_col = column
-                break
+    index_columns = [column for column in required_columns if column in df.index.names]
+    # Check every column for missing values in one pass over the dataframe
+    missing = df[
+        [column for column in required_columns if column not in index_columns]
+    ].isna().any()
+    for column in index_columns:
+        missing[column] = df.index.get_level_values(column).isna().any()
+    # Report the first column that is missing data
+    bad_col = next((column for column in required_columns if missing[column]), None)
     if bad_col is None:
         return True
     else:
@@ -45,10 +55,8 @@ def output_new_transaction_data(
     if os.path.isfile(outfile):
         # Create a temp version of the transactions with today's data
         dir_name = os.path.dirname(outfile)
-        file_name = (
-            os.path.splitext(os.path.basename(outfile))[0]
-            + f"-{datetime.today().date():%Y-%m-%d}.csv"
-        )
+        base_name, ext = os.path.splitext(os.path.basename(outfile))
+        file_name = base_name + f"-{datetime.today().date():%Y-%m-%d}{ext}"
         outfile = os.path.join(dir_name, file_name)
 
     write_dated_df_to_csv(df, outfile, sort_by_date=sort_by_date)
@@ -57,10 +65,48 @@ def output_new_transaction_data(
 
 
 def write_dated_df_to_csv(df, outfile, date_col=DATE, sort_by_date=True, index=False):
+    """Writes df to outfile, as a zstd compressed parquet file if its name ends
+    with .parquet or as a csv file otherwise
+    """
     if sort_by_date:
         df = df.copy()
         df.sort_values(by=date_col, ascending=False, inplace=True)
-    df.to_csv(outfile, index=index)
+    if is_parquet_file(outfile):
+        if index:
+            df = df.reset_index()
+        write_lm_transactions_parquet(df, outfile)
+    else:
+        df.to_csv(outfile, index=index)
+
+
+def is_parquet_file(path):
+    """Returns True if path names a parquet file"""
+    return path.endswith(".parquet")
+
+
+def write_csv(df, outfile, index=False):
+    """Writes df to a csv file using pyarrow's csv writer, which formats whole
+    columns at a time rather than building each row in python.
+
+    Timestamps without a time of day are written as dates, like pandas does.
+    If a column can't be converted to arrow, for example because it mixes strings
+    and numbers, the file is written with DataFrame.to_csv instead
+    """
+    if index:
+        df = df.reset_index(names="")
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        df.to_csv(outfile, index=False)
+        return
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            column = table.column(i)
+            if pc.all(pc.equal(pc.floor_temporal(column, unit="day"), column)).as_py():
+                table = table.set_column(
+                    i, field.name, pc.cast(column, pa.date32(), safe=False)
+                )
+    pacsv.write_csv(table, outfile)
 
 
 def get_latest_transaction_file(path_to_data, query_user=True):
@@ -68,10 +114,8 @@ def get_latest_transaction_file(path_to_data, query_user=True):
     If a temporary copy of this file that was generated today is detected
     the user is interactively queried to see if they prefer to use that one
     """
-    file_name = (
-        os.path.splitext(os.path.basename(path_to_data))[0]
-        + f"-{datetime.today().date():%Y-%m-%d}.csv"
-    )
+    base_name, ext = os.path.splitext(os.path.basename(path_to_data))
+    file_name = base_name + f"-{datetime.today().date():%Y-%m-%d}{ext}"
     file_path = os.path.join(CACHE_DIR, file_name)
     if os.path.exists(file_path):
         if query_user:
@@ -90,12 +134,25 @@ def get_latest_transaction_file(path_to_data, query_user=True):
 
 
 def read_local_transaction_csv(path_to_data, index_on_date=True, validate_data=True):
+    """Reads the local transaction data from path_to_data, which may be a csv or
+    a parquet file.  If a parquet file doesn't exist yet but a csv file with the
+    same name does, the csv file is read, so that it is converted to parquet the
+    next time the local transaction data is written
+    """
     # See if we have an updated transaction data file from a previous run today
     path_to_data = get_latest_transaction_file(path_to_data)
+    if is_parquet_file(path_to_data) and not os.path.exists(path_to_data):
+        csv_path = os.path.splitext(path_to_data)[0] + ".csv"
+        if os.path.exists(csv_path):
+            print(f"Reading {csv_path}, it will be converted to {path_to_data}")
+            path_to_data = csv_path
     if not os.path.exists(path_to_data):
         return None
     # Read the local transaction data into a dataframe
-    df = read_lm_transactions_csv(path_to_data)
+    if is_parquet_file(path_to_data):
+        df = read_local_transaction_parquet(path_to_data)
+    else:
+        df = read_cached_transaction_csv(path_to_data)
     if validate_data:
         if not validate_transactions(df, COLS_TO_VALIDATE):
             print(f"Invalid data found. Fix {path_to_data} and try again.")
@@ -105,3 +162,38 @@ def read_local_transaction_csv(path_to_data, index_on_date=True, validate_data=T
         df.set_index([DATE], inplace=True)
 
     return df
+
+
+def read_local_transaction_parquet(path_to_data):
+    """Reads a parquet file of transactions written by write_dated_df_to_csv"""
+    df = read_lm_transactions_parquet(path_to_data)
+    # Keep the text columns as objects with None for missing values, as they
+    # are when the data is read from a csv file
+    for column in df.select_dtypes(include=["object", "string"]).columns:
+        df[column] = df[column].astype(object).where(df[column].notna(), None)
+    return df
+
+
+def read_cached_transaction_csv(path_to_data):
+    """Reads a csv file of transactions, using a parquet copy of it in CACHE_DIR
+    if the copy is newer than the csv file.  Otherwise the csv file is parsed and
+    the copy is (re)written for the next time, so a csv file that hasn't changed
+    is only parsed once
+    """
+    # Csv files with the same name in different directories each get their own
+    # copy, named with a hash of the absolute path
+    path_hash = hashlib.sha1(os.path.abspath(path_to_data).encode()).hexdigest()[:12]
+    cache_file = os.path.join(
+        CACHE_DIR,
+        f"{os.path.basename(path_to_data)}-{path_hash}{LOCAL_TRANSACTIONS_CACHE_EXT}",
+    )
+    if os.path.isfile(cache_file):
+        if os.path.getmtime(cache_file) >= os.path.getmtime(path_to_data):
+            return read_local_transaction_parquet(cache_file)
+
+    df = read_lm_transactions_csv(path_to_data)
+    try:
+        write_lm_transactions_parquet(df, cache_file)
+    except Exception as e:
+        print(f"Failed to write to {cache_file}. Reason: {e}")
+    return df
@@ -0,0 +1,71 @@
+"""rate_limiter.py
+
+   This module provides a token bucket rate limiter for the LunchMoney API, and a
+   helper to make a batch of API calls concurrently without exceeding it.
+
+   The lunchable client is synchronous, so the calls are run on a small pool of
+   threads.  Waiting on the network doesn't hold the GIL, so the round trips
+   overlap.  The rate itself is enforced by the client from lib/lm_client.py,
+   which takes a token from a single shared bucket for every request and
+   retries requests rejected with HTTP 429 (Too Many Requests).
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import lunchmoney_config as lmc
+
+# Older configs won't have a rate limit, default to 5 requests a second
+LM_API_REQUESTS_PER_SECOND = getattr(lmc, "LM_API_REQUESTS_PER_SECOND", 5)
+
+
+class TokenBucket:
+    """A thread safe token bucket that allows rate calls per period seconds, with
+    bursts of up to rate calls when the bucket is full
+    """
+
+    def __init__(self, rate, per=1.0):
+        self.capacity = rate
+        self.fill_rate = rate / per
+        self.tokens = float(rate)
+        self.last_fill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token from the bucket, sleeping until one is available"""
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last_fill) * self.fill_rate
+                )
+                self.last_fill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.fill_rate)
+
+
+def run_rate_limited(calls, rate=LM_API_REQUESTS_PER_SECOND, return_exceptions=False):
+    """Runs each of the functions in calls, which take no arguments, on a pool of
+    threads.  The calls are expected to use the client from lib/lm_client.py,
+    which keeps them under the API rate limit, so the pool only needs enough
+    threads to keep rate requests a second in flight.
+
+    Returns: a list with the value returned by each call, in the same order.  If a
+    call raises an exception it is re-raised here, unless return_exceptions is
+    True in which case the exception is returned in its place in the list
+    """
+    if not calls:
+        return []
+
+    def call_and_catch(call):
+        try:
+            return call()
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with ThreadPoolExecutor(max_workers=min(len(calls), max(1, int(rate)))) as pool:
+        return list(pool.map(call_and_catch, calls))
@@ -0,0 +1,62 @@
+"""transaction_format.py
+
+   This module formats lunchmoney transactions as one line descriptions, for
+   the utilities that ask the user about them.
+"""
+
+# Fields shown for a transaction, after the date, with their label
+FORMATTED_FIELDS = {
+    "amount": "Amount",
+    "payee": "Payee",
+    "category_name": "Category Name",
+    "account_display_name": "Account Display Name",
+    "notes": "Notes",
+}
+
+
+def format_transaction(transaction):
+    """
+    Format a transaction series into a string with specific fields formatted.
+    - Date is converted to 'YYYY-MM-DD'.
+    - Tags are converted from a list of objects to a comma-separated string of names.
+    """
+    # Extract and format the date
+    formatted_date = transaction["date"].strftime("%Y-%m-%d")
+
+    # Extract and format the tags
+    formatted_tags = format_tags(transaction["tags"])
+
+    # Create the formatted string
+    formatted_transaction = (
+        f"Date: {formatted_date}, "
+        f"Amount: {transaction['amount']}, "
+        f"Payee: {transaction['payee']}, "
+        f"Category Name: {transaction['category_name']}, "
+        f"Account Display Name: {transaction['account_display_name']}, "
+        f"Notes: {transaction['notes']}, "
+        f"Tags: {formatted_tags}"
+    )
+
+    return formatted_transaction
+
+
+def format_transactions(df):
+    """
+    Returns a series with the string format_transaction would return for each
+    transaction in df, built a column at a time
+    """
+    formatted = "Date: " + df["date"].dt.strftime("%Y-%m-%d").astype(object)
+    for field, label in FORMATTED_FIELDS.items():
+        # Format the values as the f-string in format_transaction would
+        formatted += f", {label}: " + df[field].astype(object).map(str)
+    return formatted + ", Tags: " + df["tags"].map(format_tags)
+
+
+def format_tags(tags):
+    """Returns a comma-separated string of the names in a list of tag objects.
+    The type is checked first since the truth value of an array of tags is
+    ambiguous
+    """
+    if isinstance(tags, list):
+        return ", ".join([tag["name"] for tag in tags if "name" in tag])
+    return ""
@@ -12,11 +12,20 @@
 """
 
 import ast
+import copy
+import json
+import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import sys
-from lunchable import LunchMoney
+from functools import partial
 from lunchable.models import TransactionUpdateObject
+from lib import lm_client
+from lib.rate_limiter import run_rate_limited
+from config import lunchmoney_config as lmc
 from config.lunchmoney_config import (
     LUNCHMONEY_API_TOKEN,
     CACHE_DIR,
@@ -27,14 +36,37 @@ sys.path.append("..")
 
 private_lunch = None
 
+# Older configs won't have a cache extension, default to parquet
+LM_FETCHED_TRANSACTIONS_CACHE_EXT = getattr(
+    lmc, "LM_FETCHED_TRANSACTIONS_CACHE_EXT", ".parquet"
+)
+# Columns from the API that hold python lists or dicts
+NESTED_COLUMNS = ["tags", "plaid_metadata", "children"]
+# Columns of a transactions CSV file that read_lm_transactions_csv parses as
+# numbers or dates, every other column is read as text
+CSV_NUMERIC_COLUMNS = {"amount": "float64", "to_base": "float64"}
+CSV_DATE_COLUMNS = ["date", "created_at", "updated_at"]
+# Date columns the API gives as UTC times with a zone offset, which the arrow
+# reader only parses into a timestamp type with a time zone
+CSV_UTC_DATE_COLUMNS = ["created_at", "updated_at"]
+# Columns of True/False values
+BOOL_COLUMNS = [
+    "is_pending",
+    "is_income",
+    "exclude_from_budget",
+    "exclude_from_totals",
+    "has_children",
+    "is_group",
+]
+
 
 def init_lunchable(token=None):
     global private_lunch
     if private_lunch is None:
         if token is None:
-            private_lunch = LunchMoney(access_token=LUNCHMONEY_API_TOKEN)
+            private_lunch = lm_client.init_lunchable(LUNCHMONEY_API_TOKEN)
         else:
-            private_lunch = LunchMoney(access_token=token)
+            private_lunch = lm_client.init_lunchable(token)
     return private_lunch
 
 
@@ -77,6 +109,24 @@ def str_to_bool(x):
         return False
 
 
+# The strings that str_to_bool treats as True
+TRUE_STRINGS = ["True", "TRUE", "true"]
+
+
+def ids_to_str_or_none(ids):
+    """Does what id_to_str_or_none does to each id in the Series ids, a whole column
+    at a time.  Whole number ids are written without a decimal point
+    """
+    numbers = pd.to_numeric(ids, errors="coerce").to_numpy(dtype=np.float64)
+    present = ~np.isnan(numbers)
+    whole = present & (np.floor(numbers) == numbers)
+    fraction = present & ~whole
+    result = np.full(len(numbers), None, dtype=object)
+    result[whole] = numbers[whole].astype(np.int64).astype(str).tolist()
+    result[fraction] = [str(number) for number in numbers[fraction].tolist()]
+    return pd.Series(result.tolist(), index=ids.index)
+
+
 def lunchmoney_update_transaction(id, transaction_fields, lunch=None):
     """Updated the transaction with id, to have whatever new values are
     in set in the transaction_fields object
@@ -95,6 +145,56 @@ def lunchmoney_update_transaction(id, transaction_fields, lunch=None):
         return None
 
 
+def queue_transaction_update(pending_updates, id, transaction_fields):
+    """Adds the update of the transaction with id to pending_updates, a dict of
+    transaction id -> transaction_fields, to be made later by
+    lunchmoney_update_transactions.  If the transaction already has an update
+    queued the fields are merged, so the last value queued for each field wins
+    """
+    pending_updates.setdefault(id, {}).update(transaction_fields)
+
+
+def lunchmoney_update_transactions(pending_updates, lunch=None):
+    """Makes the API calls for all of the updates queued in pending_updates, a dict
+    of transaction id -> transaction_fields, concurrently while staying under the
+    API rate limit.  pending_updates is emptied once the calls are done.
+
+    Returns: the number of transactions that were updated
+    """
+    if not pending_updates:
+        return 0
+    if lunch is None:
+        lunch = init_lunchable()
+
+    def update_transaction(id, transaction_fields):
+        update_object = TransactionUpdateObject(**transaction_fields)
+        response = lunch.update_transaction(id, update_object)
+        if not response.get("updated"):
+            raise ValueError(f"Lunch Money PUT /transactions returned {response}")
+        return response
+
+    print(f"Updating {len(pending_updates)} transactions in LunchMoney...")
+    results = run_rate_limited(
+        [partial(update_transaction, *update) for update in pending_updates.items()],
+        return_exceptions=True,
+    )
+    failed = [
+        (id, result)
+        for (id, result) in zip(pending_updates, results)
+        if isinstance(result, Exception)
+    ]
+    num_updated = len(pending_updates) - len(failed)
+    pending_updates.clear()
+    if failed:
+        print(f"Error in lunchmoney_update_transactions, {len(failed)} failed:")
+        for id, e in failed:
+            print(f"{id}: {e}")
+        user_input = input("Do you want to continue? (y/n): ").strip().lower()
+        if user_input != 'y':
+            sys.exit()
+    return num_updated
+
+
 def read_or_fetch_lm_transactions(
     start_date,
     end_date,
@@ -104,27 +204,33 @@ def read_or_fetch_lm_transactions(
 ):
     """Returns a dataframe of transactions from lunchmoney
 
-    If the file csv_file_base-start_date-end_date.csv exists they
-    are read from there, otherwise the are pulled via the lunchmoney
-    GET /transactions API.
+    If the file cache_file_base-start_date-end_date.parquet (or a .csv file from
+    an earlier version) exists they are read from there, otherwise the are pulled
+    via the lunchmoney GET /transactions API.
 
     For the API to work the environment variable LUNCHMONEY_API_TOKEN must
     be set to a token acquired from https://my.lunchmoney.app/developers
     """
     try:
-        csv_file = os.path.join(
+        cache_file_base = os.path.join(
             CACHE_DIR,
             (
                 f"{LM_FETCHED_TRANSACTIONS_CACHE}-"
                 f"{start_date.strftime('%Y_%m_%d')}-"
-                f"{end_date.strftime('%Y_%m_%d')}.csv"
+                f"{end_date.strftime('%Y_%m_%d')}"
             ),
         )
-        if os.path.isfile(csv_file):
-            # We have a cached version of the same transaction request written as a CSV
-            # Read it in from the CSV normalizing the data as if it had come from the API
-            df = read_lm_transactions_csv(csv_file)
-            print(f"Read {len(df)} transactions from {csv_file}.")
+        cache_file = cache_file_base + LM_FETCHED_TRANSACTIONS_CACHE_EXT
+        csv_file = cache_file_base + ".csv"
+        if os.path.isfile(cache_file) or os.path.isfile(csv_file):
+            # We have a cached version of the same transaction request
+            # Read it in, normalizing the data as if it had come from the API
+            if os.path.isfile(cache_file) and cache_file.endswith(".parquet"):
+                df = read_lm_transactions_parquet(cache_file)
+            else:
+                cache_file = csv_file
+                df = read_lm_transactions_csv(cache_file)
+            print(f"Read {len(df)} transactions from {cache_file}.")
             print("Just delete this file if you want to re-fetch them again in the future.")
 
         else:
@@ -132,13 +238,16 @@ def read_or_fetch_lm_transactions(
             print("Attempting to fetch your lunch money transactions via the API...")
             df = lunchmoney_transactions_to_df(start_date, end_date, lunch)
             print(f"Got all {len(df)} of them.")
-            print(f"Will write them to {csv_file} for faster future access.")
+            print(f"Will write them to {cache_file} for faster future access.")
             print("Just delete this file if you want to re-fetch them again in the future.")
 
             try:
-                df.to_csv(csv_file, index=False)
+                if cache_file.endswith(".parquet"):
+                    write_lm_transactions_parquet(df, cache_file)
+                else:
+                    df.to_csv(cache_file, index=False)
             except Exception as e:
-                print(f"Failed to write to {csv_file}. Reason: {e}")
+                print(f"Failed to write to {cache_file}. Reason: {e}")
                 print(
                     "Consider modifying CACHE_DIR and/or LM_FETCHED_TRANSACTIONS_CACHE "
                     "in the config file."
@@ -171,45 +280,46 @@ def ensure_consistent_types(df, source):
         )
         return df
     if source == "csv":
-        # Values read directly from the API treat empty as None, match it for CSV files
-        df = df.where(pd.notnull(df), None)  # df.fillna("", inplace=True)
-        # All Dates are pandas timestamp objects:
-        df["date"] = pd.to_datetime(df["date"], errors="coerce")
-        df["created_at"] = pd.to_datetime(df["created_at"], errors="coerce")
-        df["update_at"] = pd.to_datetime(df["updated_at"], errors="coerce")
-        # Convert amounts to floats:
-        df["amount"] = pd.to_numeric(df["amount"], errors="coerce")
-        df["to_base"] = pd.to_numeric(df["to_base"], errors="coerce")
-        # Convert True/False strings to Boolean
-        df["is_pending"] = df["is_pending"].apply(str_to_bool)
-        df["is_income"] = df["is_income"].apply(str_to_bool)
-        df["exclude_from_budget"] = df["exclude_from_budget"].apply(str_to_bool)
-        df["exclude_from_totals"] = df["exclude_from_totals"].apply(str_to_bool)
-        df["has_children"] = df["has_children"].apply(str_to_bool)
-        df["is_group"] = df["is_group"].apply(str_to_bool)
+        # read_lm_transactions_csv has already parsed the numbers and dates.
+        # Values read directly from the API treat empty as None, match it for the
+        # text columns of CSV files
+        for column in df.select_dtypes(include="object").columns:
+            df[column] = df[column].where(df[column].notna(), None)
+        # All Dates are pandas timestamp objects, parse any that read_csv couldn't
+        for column in CSV_DATE_COLUMNS:
+            if column in df.columns and not pd.api.types.is_datetime64_any_dtype(
+                df[column]
+            ):
+                df[column] = pd.to_datetime(df[column], errors="coerce")
+        # Convert True/False strings to Boolean, as str_to_bool does
+        for column in BOOL_COLUMNS:
+            df[column] = df[column].isin(TRUE_STRINGS)
         # API returns "" if no Account Display Name (not "Cash transaction")
         df["account_display_name"] = df["account_display_name"].fillna('')
-        # Restore the Objects:
-        df["tags"] = df["tags"].apply(
-            lambda val: ast.literal_eval(val) if isinstance(val, str) else val
+        # Restore the Objects.  Many rows have the same tags, so each distinct
+        # string is only parsed once, and every row gets its own copy since the
+        # tag lists are appended to in place
+        literals = parse_literals(df["tags"])
+        df["tags"] = df["tags"].map(
+            lambda val: copy.copy(literals[val]) if isinstance(val, str) else val
         )
-        df["plaid_metadata"] = df["plaid_metadata"].apply(
-            lambda val: (
-                ast.literal_eval(val)
-                if isinstance(val, str) and val.startswith(("{", "["))
-                else {}
-            )
+        literals = parse_literals(df["plaid_metadata"], prefixes=("{", "["))
+        df["plaid_metadata"] = df["plaid_metadata"].map(
+            lambda val: copy.copy(literals.get(val, {})) if isinstance(val, str) else {}
         )
     else:
         # ID fields from lunchable API are inconsistently treated as numeric
         # We never do math on them, so treat them as strings
-        df["id"] = df["id"].apply(id_to_str_or_none)
-        df["recurring_id"] = df["recurring_id"].apply(id_to_str_or_none)
-        df["category_id"] = df["category_id"].apply(id_to_str_or_none)
-        df["parent_id"] = df["parent_id"].apply(id_to_str_or_none)
-        df["plaid_account_id"] = df["plaid_account_id"].apply(id_to_str_or_none)
+        for column in [
+            "id",
+            "recurring_id",
+            "category_id",
+            "parent_id",
+            "plaid_account_id",
+        ]:
+            df[column] = ids_to_str_or_none(df[column])
         # Massage out any newlines or leading/trailing spaces in any of the fields
-        df = df.apply(clean_up_white_space_from_api)
+        df = clean_up_white_space_from_api(df)
         # Since data has no timestamp info it became a python datetime.date object
         # Convert it to a pandas timestamp so we can be consistent in how we
         # operate on all date/time like objects
@@ -218,12 +328,74 @@ def ensure_consistent_types(df, source):
     return df
 
 
-def clean_up_white_space_from_api(x):
-    """Removes embedded new lines, leading/trailing white space from strings"""
-    if not isinstance(x, str):
-        return x
-    else:
-        return x.replace("\n", " ").strip()
+def parse_literals(values, prefixes=None):
+    """Returns a dict that maps each distinct string in values to the python
+    literal it holds, as written to a CSV file by to_csv.  If prefixes is passed
+    only the strings that start with one of them are parsed
+    """
+    return {
+        value: ast.literal_eval(value)
+        for value in pd.unique(values)
+        if isinstance(value, str) and (prefixes is None or value.startswith(prefixes))
+    }
+
+
+def clean_up_white_space_from_api(df):
+    """Removes embedded new lines, leading/trailing white space from the strings in
+    each of the text columns of df, a whole column at a time
+    """
+    for column in df.select_dtypes(include=["object", "string"]).columns:
+        if column in NESTED_COLUMNS:
+            continue
+        values = df[column]
+        try:
+            cleaned = values.str.replace("\n", " ", regex=False).str.strip()
+        except AttributeError:
+            # No strings in this column
+            continue
+        # Anything that isn't a string comes back as NaN, keep the original
+        df[column] = cleaned.where(cleaned.notna(), values)
+    return df
+
+
+def write_lm_transactions_parquet(df, path):
+    """Writes a dataframe of lunchmoney transactions to a zstd compressed parquet
+    file.  Parquet keeps the column types, so nothing needs to be parsed when the
+    file is read back.  The tags are stored as a native list of structs, the other
+    list and dict columns don't have a consistent shape so they are stored as
+    JSON text
+    """
+    df = df.copy()
+    for column in NESTED_COLUMNS:
+        if column != "tags" and column in df.columns:
+            df[column] = df[column].map(lambda val: json.dumps(val, default=str))
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # The tags didn't have a shape arrow could infer, fall back to JSON
+        df["tags"] = df["tags"].map(lambda val: json.dumps(val, default=str))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path, compression="zstd", row_group_size=64 * 1024)
+
+
+def read_lm_transactions_parquet(path):
+    """Reads a parquet file written by write_lm_transactions_parquet"""
+    table = pq.read_table(path)
+    tags = None
+    if "tags" in table.column_names and pa.types.is_list(
+        table.schema.field("tags").type
+    ):
+        # pandas would turn each list into a numpy array, keep them python lists
+        tags_position = table.schema.get_field_index("tags")
+        tags = table.column("tags").to_pylist()
+        table = table.drop_columns(["tags"])
+    df = table.to_pandas()
+    if tags is not None:
+        df.insert(tags_position, "tags", tags)
+    for column in NESTED_COLUMNS:
+        if column in df.columns and (column != "tags" or tags is None):
+            df[column] = df[column].map(json.loads)
+    return df
 
 
 def read_lm_transactions_csv(path_to_data):
@@ -284,9 +456,29 @@ def read_lm_transactions_csv(path_to_data):
         # }
         #        df = pd.read_csv(path_to_data, converters=converters)
         #        df = pd.read_csv(path_to_data, converters=converters, dtype=object, keep_default_na=True, na_values=[''])
-        df = pd.read_csv(
-            path_to_data, dtype=object, keep_default_na=True, na_values=[""]
-        )
+        # Give the reader the type of every column so the numbers and dates are
+        # parsed in the same pass, and the rest are kept as text like the API's
+        columns = pd.read_csv(path_to_data, nrows=0).columns
+        try:
+            df = read_csv_with_arrow(path_to_data, columns)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Arrow couldn't parse a number or date, the pandas parser is
+            # more forgiving
+            df = pd.read_csv(
+                path_to_data,
+                dtype={
+                    column: CSV_NUMERIC_COLUMNS.get(column, object)
+                    for column in columns
+                    if column not in CSV_DATE_COLUMNS
+                },
+                parse_dates=[
+                    column for column in CSV_DATE_COLUMNS if column in columns
+                ],
+                # The dates are written as ISO 8601, don't infer their format
+                date_format="ISO8601",
+                keep_default_na=True,
+                na_values=[""],
+            )
         df = ensure_consistent_types(df, source="csv")
 
     except BaseException as e:
@@ -305,30 +497,68 @@ def read_lm_transactions_csv(path_to_data):
     return df
 
 
+def read_csv_with_arrow(path_to_data, columns):
+    """Reads a transactions CSV file with the multithreaded pyarrow reader, as the
+    columns that read_lm_transactions_csv would give to pd.read_csv
+    """
+    column_types = {column: pa.string() for column in columns}
+    for column, dtype in CSV_NUMERIC_COLUMNS.items():
+        column_types[column] = pa.from_numpy_dtype(np.dtype(dtype))
+    for column in CSV_DATE_COLUMNS:
+        tz = "UTC" if column in CSV_UTC_DATE_COLUMNS else None
+        column_types[column] = pa.timestamp("us", tz=tz)
+    table = pacsv.read_csv(
+        path_to_data,
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=True
+        ),
+    )
+    df = table.to_pandas()
+    # Keep the text columns as objects, as pd.read_csv(dtype=object) would
+    text_columns = [
+        column
+        for column in columns
+        if column not in CSV_NUMERIC_COLUMNS and column not in CSV_DATE_COLUMNS
+    ]
+    return df.astype({column: object for column in text_columns})
+
+
 def remove_parents_of_split_transactions(df):
     """remove any parents of split transactions"""
-    parents = df[df["has_children"]]
-    for parent_id in parents["id"]:
-        if parent_id not in df["parent_id"].values:
-            print(f"Parent id {parent_id} does not exist in the dataframe.")
-            sys.exit(1)
-    print(f"Removing {len(parents)} parents of transactions that were split")
-    return df[~df["has_children"]]
+    is_parent = df["has_children"].to_numpy(dtype=bool)
+    parent_ids = df["id"][is_parent]
+    # Every parent should have its children in the dataframe too
+    missing = ~parent_ids.isin(df["parent_id"]).to_numpy()
+    if missing.any():
+        missing_id = parent_ids[missing].iloc[0]
+        print(f"Parent id {missing_id} does not exist in the dataframe.")
+        sys.exit(1)
+    print(f"Removing {len(parent_ids)} parents of transactions that were split")
+    if len(parent_ids) == 0:
+        return df
+    return df[~is_parent]
 
 
 def remove_pending_transactions(df):
     """remove any pending transactions"""
-    all_trans = len(df)
-    df = df[~df["is_pending"]]
-    num_pending = all_trans - len(df)
+    is_pending = df["is_pending"].to_numpy(dtype=bool)
+    num_pending = int(is_pending.sum())
     print(f"Removing {num_pending} new transactions that are pending.")
-    return df
+    if num_pending == 0:
+        # The API leaves out pending transactions unless asked for them, so there
+        # usually aren't any and the dataframe doesn't need to be copied
+        return df
+    return df[~is_pending]
 
 
-def lunchmoney_delete_transaction(id, existing_tag_names):
+def lunchmoney_delete_transaction(id, existing_tag_names, pending_updates=None):
     """Ideally this would removes the transactions with the id passed in
     Since the LM API does not support the ability to delete transactions instead
     we'll add a Duplicate tag that the user can filter on for manual deletion
+
+    If pending_updates is passed the update is queued in it for
+    lunchmoney_update_transactions instead of being made right away
     """
     # TODO Change this to really delete it when API becomes available
     update_obj = {}
@@ -338,4 +568,7 @@ def lunchmoney_delete_transaction(id, existing_tag_names):
     else:
         update_obj["tags"] = ["Duplicate"]
 
-    lunchmoney_update_transaction(id, update_obj)
+    if pending_updates is None:
+        lunchmoney_update_transaction(id, update_obj)
+    else:
+        queue_transaction_update(pending_updates, id, update_obj)
@@ -9,7 +9,7 @@ import sys
 # import os
 
 from config import lunchmoney_config as lmc
-from lunchable import LunchMoney
+from lib.lm_client import init_lunchable
 from lunchable.models import TransactionUpdateObject
 from typing import Any, Dict
 
@@ -17,18 +17,21 @@ from typing import Any, Dict
 def main():
     """
     Iterates through all tags and checks if they have transactions
+
+    All of the transactions are fetched once and the ids of their tags collected,
+    rather than fetching the transactions for each tag
     """
     # Since we are working with both the tags and transactions APIs we'll initialize
     # lunchable here
-    lunch = LunchMoney(access_token=lmc.LUNCHMONEY_API_TOKEN)
+    lunch = init_lunchable(lmc.LUNCHMONEY_API_TOKEN)
     tags = lunch.get_tags()
 
+    trans = lunch.get_transactions(start_date="2000-01-01", end_date="3000-01-01")
+    used_tag_ids = {tag.id for transaction in trans for tag in transaction.tags or []}
+
     for tag in tags:
-        trans = lunch.get_transactions(
-            tag_id=tag.id, start_date="2000-01-01", end_date="3000-01-01"
-        )
-        if len(trans) == 0:
-            print(f"There are {len(trans)} transactions with the tag '{tag.name}'")
+        if tag.id not in used_tag_ids:
+            print(f"There are 0 transactions with the tag '{tag.name}'")
             if tag in lmc.VALID_TAGS:
                 print('--Unexpected?')
 
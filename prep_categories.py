@@ -33,11 +33,14 @@ if __name__ == "__main__":
     # Read proposed spending groups and categories
     spending_groups_df = read_spending_groups("config", SPENDING_GROUP_DEFINITIONS)
     # Ensure that no category is assigned to more than one group
-    all_values = (
-        spending_groups_df.values.flatten().tolist()
-        + spending_groups_df.columns.tolist()
+    all_values = pd.concat(
+        [
+            pd.Series(spending_groups_df.to_numpy().ravel()),
+            pd.Series(spending_groups_df.columns),
+        ],
+        ignore_index=True,
     )
-    value_counts = pd.Series(all_values).value_counts()
+    value_counts = all_values.value_counts()
     duplicated_values = value_counts[value_counts > 1]
     if not duplicated_values.empty:
         print("Duplicated values found:")
@@ -90,6 +93,19 @@ if __name__ == "__main__":
     for name in proposed_groups:
         proposed_group_objects.append({"name": name, "type": "to_be_created"})
 
+    # Map each category name in the proposed definitions to the group whose column
+    # it is in, and each group name to its object, so they are looked up directly
+    proposed_categories = spending_groups_df.melt(
+        var_name="group", value_name="category"
+    ).dropna()
+    proposed_categories = proposed_categories.drop_duplicates("category")
+    group_by_category = dict(
+        zip(proposed_categories["category"], proposed_categories["group"])
+    )
+    group_objects_by_name = {}
+    for item in proposed_group_objects:
+        group_objects_by_name.setdefault(item["name"], item)
+
     # Evaluate the remaining categories to be put in one of the proposed groups
     for category in remaining_categories:
         category["in_group"] = False
@@ -99,22 +115,12 @@ if __name__ == "__main__":
             # be renamed and then later added to the group once it is created
             proposed_group = category["name"]
         else:
-            for col in spending_groups_df.columns:
-                if category["name"] in spending_groups_df[col].values.tolist():
-                    proposed_group = col
-                    break
+            proposed_group = group_by_category.get(category["name"])
         if proposed_group:
             # This category belongs in one of the proposed_groups, add it to the
             # list of category ids to be updated with the group id once it's created
             category["in_group"] = True
-            group_obj = next(
-                (
-                    item
-                    for item in proposed_group_objects
-                    if item["name"] == proposed_group
-                ),
-                None,
-            )
+            group_obj = group_objects_by_name.get(proposed_group)
             if group_obj:
                 if "categories_to_add" not in group_obj:
                     group_obj["categories_to_add"] = []
@@ -19,7 +19,7 @@
 """
 
 import os
-from datetime import datetime
+from datetime import date, datetime
 from lib.transactions import read_or_fetch_lm_transactions
 from lib.find_and_process_dups import find_duplicate_transactions
 from config.lunchmoney_config import (
@@ -29,11 +29,14 @@ from config.lunchmoney_config import (
     LOOKBACK_LM_DUP_DAYS,
 )
 
+START_DATE = datetime.strptime(START_DATE_STR, "%m/%d/%Y")
+END_DATE = datetime.strptime(END_DATE_STR, "%m/%d/%Y")
+
 if __name__ == "__main__":
     # Fetch the transactions from LunchMoney
     df = read_or_fetch_lm_transactions(
-        datetime.strptime(START_DATE_STR, "%m/%d/%Y"),
-        datetime.strptime(END_DATE_STR, "%m/%d/%Y"),
+        START_DATE,
+        END_DATE,
         remove_pending=True,
         remove_split_parents=True,
     )
@@ -43,7 +46,7 @@ if __name__ == "__main__":
     if len(dup_ids):
         # We found duplicates, write them to a CSV file to be examined
         dup_df = df[df["id"].isin(dup_ids)]
-        today_date_str = datetime.now().strftime("%Y-%m-%d")
+        today_date_str = date.today().isoformat()
         output_file_path = os.path.join(
             CACHE_DIR, f"marked_as_duplicate_{today_date_str}.csv"
         )
@@ -28,6 +28,7 @@
 
 # Import necessary modules
 # import shutil
+import numpy as np
 import pandas as pd
 import sys
 import os
@@ -46,6 +47,7 @@ from lib.local_transaction_utils import (
     write_dated_df_to_csv,
 )
 from lib.find_and_process_dups import find_duplicate_transactions
+from lib.transaction_format import format_transaction
 
 
 # Fetch the latest transactions from lunch money and update a 
@@ -141,9 +143,10 @@ def get_new_lunchmoney_transactions(existing_df, lookback_days):
 
 def exit_if_transactions_not_ready(df):
     """Exits if there are any transactions that still need to be reviewed"""
-    unreviewed = df[df.status == "uncleared"]
-    if len(unreviewed) > 0:
-        print(f"There are {len(unreviewed)} transactions that need to be reviewed.")
+    # Count the transactions without building a dataframe of them
+    unreviewed = (df["status"].to_numpy() == "uncleared").sum()
+    if unreviewed:
+        print(f"There are {unreviewed} transactions that need to be reviewed.")
         print(
             "Please visit\n"
             "https://my.lunchmoney.app/transactions?"
@@ -181,88 +184,78 @@ def find_overlap_transactions(new_df, local_df):
         "tags",
     ]
 
-    # Find instances of the same transaction in the imported and existing local data
-    overlap_df = new_df[new_df["id"].isin(local_df["id"])]
+    # Nothing was fetched, so nothing overlaps
+    if new_df.empty:
+        return new_df
 
-    # Iterate through each transaction in overlap_df
-    for _, row in overlap_df.iterrows():
+    # Find instances of the same transaction in the imported and existing local data
+    # and pair each of them with the first local transaction with the same id, with
+    # a single lookup of the new ids in the local ones
+    first_pos = np.flatnonzero(~local_df["id"].duplicated().to_numpy())
+    local_pos = pd.Index(local_df["id"].to_numpy()[first_pos]).get_indexer(
+        new_df["id"]
+    )
+    is_overlap = local_pos >= 0
+    overlap_df = new_df[is_overlap]
+    corresponding_df = local_df.iloc[first_pos[local_pos[is_overlap]]]
+
+    # Compare the specified fields of every pair at once, and only look at the
+    # transactions that have differences
+    differs = pd.DataFrame(
+        {
+            field: values_differ(overlap_df[field], corresponding_df[field])
+            for field in fields_to_compare
+        }
+    )
+    differing_pos = np.flatnonzero(differs.any(axis=1).to_numpy())
+    differing_rows = overlap_df.iloc[differing_pos].iterrows()
+    for pos, (_, row) in zip(differing_pos, differing_rows):
         # Get the corresponding transaction in local_df
-        corresponding_transaction = local_df[local_df["id"] == row["id"]]
-
-        # Check if there is a corresponding transaction
-        if not corresponding_transaction.empty:
-            # Compare the specified fields
-            differences = []
-            for field in fields_to_compare:
-                if row[field] != corresponding_transaction[field].values[0]:
-                    differences.append(field)
-
-            # If there are differences, print both transactions for the differing fields
-            if differences:
-                print(
-                    f"\nFound differences in {differences} fields between "
-                    "new and local transactions."
-                )
-                print(f"Newly imported Transaction:\n{format_transaction(row)}")
-                print(
-                    "Existing local Transactions:\n"
-                    f"{format_transaction(corresponding_transaction.iloc[0])}"
-                )
-                print("\n")  # Add a newline for better readability
-                response = ""
-                while response.lower() != "n" and response.lower() != "e":
-                    response = input("Which one is right (n/e): ")
-                if response == "n":
-                    existing_index = corresponding_transaction.index[0]
-                    for field in differences:
-                        local_df.at[existing_index, field] = row[field]
-                else:
-                    # update the lunchmoney transaction with the new values
-                    lunchmoney_update_transaction(
-                        row["id"],
-                        {
-                            field: corresponding_transaction[field].values[0]
-                            for field in differences
-                        },
-                    )
+        corresponding_transaction = corresponding_df.iloc[pos]
+        differences = [field for field in fields_to_compare if differs[field].iat[pos]]
 
+        # Print both transactions for the differing fields
+        print(
+            f"\nFound differences in {differences} fields between "
+            "new and local transactions."
+        )
+        print(f"Newly imported Transaction:\n{format_transaction(row)}")
+        print(
+            "Existing local Transactions:\n"
+            f"{format_transaction(corresponding_transaction)}"
+        )
+        print("\n")  # Add a newline for better readability
+        response = ""
+        while response not in ("n", "e"):
+            response = input("Which one is right (n/e): ").strip().lower()
+        if response == "n":
+            existing_index = corresponding_df.index[pos]
+            for field in differences:
+                local_df.at[existing_index, field] = row[field]
         else:
-            print("WARNING: Did not find existing transaction to match new trans:")
-            print(row[fields_to_compare])
+            # update the lunchmoney transaction with the new values
+            lunchmoney_update_transaction(
+                row["id"],
+                {
+                    field: corresponding_df[field].values[pos]
+                    for field in differences
+                },
+            )
 
-        return overlap_df
+    return overlap_df
 
 
-def format_transaction(transaction):
+def values_differ(new_values, local_values):
     """
-    Format a transaction series into a string with specific fields formatted.
-    - Date is converted to 'YYYY-MM-DD'.
-    - Tags are converted from a list of objects to a comma-separated string of names.
+    Returns a boolean array that is True where the values in the two aligned
+    series are different.  Values that are missing in both are the same.
     """
-    # Extract and format the date
-    formatted_date = transaction["date"].strftime("%Y-%m-%d")
-
-    # Extract and format the tags
-    if transaction["tags"] and isinstance(transaction["tags"], list):
-        formatted_tags = ", ".join(
-            tag["name"] for tag in transaction["tags"] if "name" in tag
-        )
-    else:
-        formatted_tags = ""
-
-    # Create the formatted string
-    formatted_transaction = (
-        f"Date: {formatted_date}, "
-        f"Amount: {transaction['amount']}, "
-        f"Payee: {transaction['payee']}, "
-        f"Category Name: {transaction['category_name']}, "
-        f"Account Display Name: {transaction['account_display_name']}, "
-        f"Notes: {transaction['notes']}, "
-        f"Tags: {formatted_tags}"
+    new_values = new_values.to_numpy(dtype=object)
+    local_values = local_values.to_numpy(dtype=object)
+    return (new_values != local_values) & ~(
+        pd.isna(new_values) & pd.isna(local_values)
     )
 
-    return formatted_transaction
-
 
 def main():
     update_local_transactions
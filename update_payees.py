@@ -15,6 +15,7 @@
 
 # Import necessary modules
 # import shutil
+import numpy as np
 import pandas as pd
 import sys
 
@@ -25,78 +26,56 @@ from update_local_transactions import (
     update_local_transactions
 )
 from lib.transactions import (
-    lunchmoney_update_transaction
+    lunchmoney_update_transactions,
+    queue_transaction_update,
 )
+from lib.transaction_format import format_transaction, format_transactions
 
 def build_update_list(df):
-    update_list = []
-
-    for index, row in df.iterrows():
-        payee = row['payee']
-        notes = row['notes'] if pd.notna(row['notes']) else ""
-        
-        # Extract the new notes
-        terminator_index = payee.find(lmc.PAYEE_TERMINATOR) if lmc.PAYEE_TERMINATOR else -1
-        if terminator_index != -1:
-            new_notes = "Paid via " + payee[:terminator_index]
-            remaining_payee = payee[terminator_index + len(lmc.PAYEE_TERMINATOR):].strip()
-        else:
-            new_notes = "Paid via " + payee
-            remaining_payee = ""
-
-        # Construct the new payee
-        if remaining_payee:
-            new_payee = remaining_payee
-            if notes:
-                new_payee += " - " + notes
-        else:
-            new_payee = notes if notes else lmc.EMPTY_PAYEE_STRING
-
-        update_list.append({
-            "id": row["id"],
-            "index": index,
-            "new_notes": new_notes,
-            "new_payee": new_payee
-        })
-
-    return update_list
-
-def format_transaction(transaction):
     """
-    Format a transaction series into a string with specific fields formatted.
-    - Date is converted to 'YYYY-MM-DD'.
-    - Tags are converted from a list of objects to a comma-separated string of names.
+    Returns a list with the id, index, new notes and new payee of every
+    transaction in df, computed column-wise rather than one row at a time
     """
-    # Extract and format the date
-    formatted_date = transaction["date"].strftime("%Y-%m-%d")
-
-    # Extract and format the tags
-    if transaction["tags"] and isinstance(transaction["tags"], list):
-        formatted_tags = ", ".join(
-            tag["name"] for tag in transaction["tags"] if "name" in tag
-        )
+    if df.empty:
+        return []
+    payee = df["payee"]
+    notes = df["notes"].fillna("")
+
+    # Extract the new notes
+    if lmc.PAYEE_TERMINATOR:
+        # partition splits at the first terminator, when there isn't one the
+        # whole payee is before it and nothing remains
+        parts = payee.str.partition(lmc.PAYEE_TERMINATOR)
+        new_notes = "Paid via " + parts[0]
+        remaining_payee = parts[2].str.strip()
     else:
-        formatted_tags = ""
-
-    # Create the formatted string
-    formatted_transaction = (
-        f"Date: {formatted_date}, "
-        f"Amount: {transaction['amount']}, "
-        f"Payee: {transaction['payee']}, "
-        f"Category Name: {transaction['category_name']}, "
-        f"Account Display Name: {transaction['account_display_name']}, "
-        f"Notes: {transaction['notes']}, "
-        f"Tags: {formatted_tags}"
+        new_notes = "Paid via " + payee
+        remaining_payee = pd.Series("", index=df.index, dtype=object)
+
+    # Construct the new payee
+    has_notes = notes != ""
+    new_payee = np.where(
+        remaining_payee != "",
+        remaining_payee + np.where(has_notes, " - " + notes, ""),
+        np.where(has_notes, notes, lmc.EMPTY_PAYEE_STRING),
     )
 
-    return formatted_transaction
+    return pd.DataFrame(
+        {
+            "id": df["id"],
+            "index": df.index,
+            "new_notes": new_notes,
+            "new_payee": new_payee,
+        },
+        index=df.index,
+    ).to_dict("records")
 
 def update_transactions(df, update_list, interactive=True):
     if (interactive):
         print(f"Found {len(df)} transactions to update")
+        formatted_transactions = format_transactions(df)
         for update in update_list:
-            transaction = df.loc[update["index"]]
-            formatted_transaction = format_transaction(transaction)
+            formatted_transaction = formatted_transactions.loc[update["index"]]
             print(f"Transaction to update: {formatted_transaction}")
             print(f"New Payee: {update['new_payee']}")
             print(f"New Notes: {update['new_notes']}")
@@ -107,28 +86,36 @@ def update_transactions(df, update_list, interactive=True):
         user_input = "y"
 
     if user_input == "y":
+        # Check all the new payees against the 140 character limit first, and ask
+        # about all of the long ones at once
+        too_long = [update for update in update_list if len(update["new_payee"]) >= 140]
+        if too_long and interactive:
+            for update in too_long:
+                print("New Payee exceeds 140 character limit: " + update["new_payee"])
+            print("Press 'y' to truncate and continue or 'n' to stop process and manually edit (y/n)", end="")
+            user_input = input().strip().lower()
+            if user_input != "y":
+                print("Return to lunch money and fix the long notes field for:")
+                for update in too_long:
+                    print(format_transaction(df.loc[update["index"]]))
+                sys.exit()
+        for update in too_long:
+            update["new_payee"] = update["new_payee"][:140]
+
+        # Then make all the API calls together
+        pending_updates = {}
         for update in update_list:
-            print(".", end="")
-            if len(update["new_payee"])>= 140:
-                if interactive:
-                    print("New Payee exceeds 140 character limit: " + update["new_payee"])
-                    print("Press 'y' to truncate and continue or 'n' to stop process and manually edit (y/n)", end="")
-                    user_input = input().strip().lower()
-                    if user_input != "y":
-                        print("Return to lunch money and fix the long notes field for:")
-                        print(format_transaction(df.loc[update["index"]]))
-                        sys.exit()
-                update["new_payee"] = update["new_payee"][:140]
-                
-            api_response = lunchmoney_update_transaction(
+            queue_transaction_update(
+                pending_updates,
                 update["id"],
                 {"payee": update["new_payee"], "notes": update["new_notes"]}
             )
-            if "updated" not in api_response or not api_response["updated"]:
-                print(f'Error calling Lunch Money PUT /transactions: {api_response}')
-                print(f'id: {update["id"]}, payee:{update["new_payee"]}, notes:{update["new_notes"]}')
-                sys.exit()
-    
+        num_to_update = len(pending_updates)
+        num_updated = lunchmoney_update_transactions(pending_updates)
+        if num_updated < num_to_update:
+            print(f"\nUpdated {num_updated} of {num_to_update} transactions.")
+            return
+
     print("\nAll transactions updated successfully.")
                 
 # TODO add a command line param to run non-interactively